@@ -9,14 +9,29 @@ ALERT_ICON = "/System/Library/CoreServices/CoreTypes.bundle/Contents/Resources/A
 def clean_dict(my_vars):
     return {key: val for (key, val) in my_vars.items() if val is not None}
 
+def format_size(size):
+    # Decimal units, as in the Finder
+    if size < 1000:
+        return f"{size} byte" + ("s" if size != 1 else "")
+    for unit in ("KB", "MB", "GB", "TB"):
+        size /= 1000
+        if size < 1000 or unit == "TB":
+            return f"{size:.1f} {unit}"
+
 #------------------- Functions to create items in Alfred ---------------------#
 
-def item_variables(next_directory, do_extraction=False, file_to_extract=None):
+def item_variables(next_directory, do_extraction=False, file_to_extract=None, page_offset=0,
+                   batch_member="", batch_action="", batch_token="", verify=0):
     
     my_vars = {
         "next_directory": next_directory,
         "file_to_extract": file_to_extract,
         "do_extraction": do_extraction,
+        "page_offset": page_offset,
+        "batch_member": batch_member,
+        "batch_action": batch_action,
+        "batch_token": batch_token,
+        "verify": verify,
     }
     return clean_dict(my_vars)
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Thin client of the resident Alzibro server (see alzibro_server.py).
+
+The scripts call forward_to_server before importing anything heavy. If the server
+answers, its output is written as is and the script stops there; otherwise the server
+is started in the background for the next calls and the script does the work itself.
+A server that could not be started is not started again before START_BACKOFF seconds,
+and a server that does not acknowledge the request within READ_TIMEOUT seconds (it may be
+busy with another one) is given up for this call.
+Once the server has acknowledged the request (with ACKNOWLEDGED, before doing anything),
+the script never does the work itself, since the server may have started extracting: a
+server that then fails, or stays silent for READ_TIMEOUT seconds (it sends HEARTBEAT
+while it works), gives an error message instead.
+'''
+import os
+import sys
+import json
+import time
+import socket
+import hashlib
+import tempfile
+import subprocess
+
+CONNECT_TIMEOUT = 0.5
+READ_TIMEOUT = 5
+START_BACKOFF = 30
+HEARTBEAT = b'.'
+ACKNOWLEDGED = b'+'
+
+def server_socket_path(cache_folder):
+    # In the temporary folder rather than in the cache folder, whose path may exceed the
+    # length allowed for a socket (104 bytes on macOS)
+    key = hashlib.sha1(os.path.abspath(cache_folder).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f"alzibro-{key}.sock")
+
+def server_start_marker(cache_folder):
+    # Written when the server is started, removed by the server once it listens
+    return server_socket_path(cache_folder) + '.start'
+
+def start_server(cache_folder):
+    marker = server_start_marker(cache_folder)
+    try:
+        if time.time() - os.path.getmtime(marker) < START_BACKOFF:
+            return
+    except OSError:
+        pass
+    script_folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(marker, 'w'):
+            pass
+        subprocess.Popen([sys.executable, os.path.join(script_folder, 'alzibro_server.py')],
+            cwd=script_folder, start_new_session=True, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+
+def server_error_message(action):
+    # Written when the server failed after taking the request over
+    from alfred import selection_error_message, alfred_error_message
+    comment = "The Alzibro server did not complete the request"
+    if action == "azb":
+        selection_error_message(comment, "Try again, or turn the resident server off")
+    else:
+        alfred_error_message(comment, os.getenv('next_directory'), os.getenv('zip_file'))
+
+def forward_to_server(action):
+    # Returns True if the server handled the request and its output was written
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if not cache_folder:
+        return False
+    request = {
+        "action": action,
+        "argv": sys.argv[1:],
+        "env": dict(os.environ),
+        "cwd": os.getcwd(),
+    }
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(server_socket_path(cache_folder))
+        except OSError:
+            start_server(cache_folder)
+            return False
+        # Extractions may take long, but the server sends heartbeats meanwhile
+        sock.settimeout(READ_TIMEOUT)
+        chunks = []
+        try:
+            sock.sendall(json.dumps(request).encode('utf-8'))
+            sock.shutdown(socket.SHUT_WR)
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        except OSError:
+            pass
+
+    response = b''.join(chunks)
+    if not response.startswith(ACKNOWLEDGED):
+        # Nothing was done by the server (which does not run a request whose client is gone)
+        return False
+    status, _, output = response[1:].lstrip(HEARTBEAT).partition(b'\n')
+    if status != b'OK':
+        server_error_message(action)
+        sys.stdout.flush()
+        return True
+    sys.stdout.buffer.write(output)
+    sys.stdout.flush()
+    return True
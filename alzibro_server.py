@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Resident Alzibro server.
+
+Started on first use by alzibro_client.forward_to_server, it keeps the modules imported
+and the parsed archives in memory (see the in-memory caches of azb.py), and answers the
+requests of azb.py, extract_from_zip.py and quick_extract.py over a Unix domain socket.
+Requests are handled one at a time: each one runs the usual main() with the client's
+variables, arguments and working directory, and its output is sent back to the client
+(preceded by an acknowledgement, then by heartbeats while it runs, so that the client
+can tell a busy server from a stuck one).
+The server quits after 'alzibro_cache_timeout' seconds without any request.
+'''
+import io
+import os
+import sys
+import json
+import fcntl
+import socket
+import threading
+
+import azb
+import extract_from_zip
+import quick_extract
+from alzibro_client import server_socket_path, server_start_marker, HEARTBEAT, ACKNOWLEDGED
+from archive_cache import purge_expired_caches, cache_timeout
+
+ACTIONS = {
+    "azb": azb.main,
+    "extract": extract_from_zip.main,
+    "quicklook": quick_extract.main,
+}
+HEARTBEAT_INTERVAL = 1
+
+#--------------------
+
+def run_request(request):
+    # Runs the requested main() as if it were launched by the client, returns its output
+    saved_env, saved_argv, saved_cwd, saved_stdout = dict(os.environ), sys.argv, os.getcwd(), sys.stdout
+    buffer = io.BytesIO()
+    try:
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = [request["action"]] + request["argv"]
+        os.chdir(request["cwd"])
+        sys.stdout = io.TextIOWrapper(buffer, encoding='utf-8', write_through=True)
+        try:
+            ACTIONS[request["action"]]()
+        except SystemExit:
+            # The scripts exit after writing an error message
+            pass
+        sys.stdout.flush()
+        return buffer.getvalue()
+    finally:
+        sys.stdout = saved_stdout
+        os.chdir(saved_cwd)
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+def send_heartbeats(conn, done):
+    while not done.wait(HEARTBEAT_INTERVAL):
+        try:
+            conn.sendall(HEARTBEAT)
+        except OSError:
+            return
+
+def handle_connection(conn):
+    chunks = []
+    while True:
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    try:
+        request = json.loads(b''.join(chunks))
+    except ValueError:
+        # The client then does the work itself
+        conn.sendall(b'ERR\n')
+        return
+    # Fails if the client gave up waiting: the request is then left to it
+    conn.sendall(ACKNOWLEDGED)
+    done = threading.Event()
+    heartbeats = threading.Thread(target=send_heartbeats, args=(conn, done), daemon=True)
+    heartbeats.start()
+    try:
+        output = run_request(request)
+    except Exception:
+        # The client then gives an error message
+        output = None
+    finally:
+        done.set()
+        heartbeats.join()
+    conn.sendall(b'ERR\n' if output is None else b'OK\n' + output)
+
+#--------------------
+
+def serve(cache_folder):
+    os.makedirs(cache_folder, exist_ok=True)
+    socket_path = server_socket_path(cache_folder)
+
+    # Only one server at a time
+    lock_file = open(socket_path + '.lock', 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return
+
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.bind(socket_path)
+        sock.listen()
+        try:
+            os.remove(server_start_marker(cache_folder))
+        except OSError:
+            pass
+        sock.settimeout(cache_timeout())
+        try:
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except socket.timeout:
+                    break
+                with conn:
+                    conn.settimeout(None)
+                    try:
+                        handle_connection(conn)
+                    except OSError:
+                        pass
+        finally:
+            os.remove(socket_path)
+            lock_file.close()
+
+    # Nothing was used during the last timeout: a last cleanup pass if the option is set
+    if os.getenv('clear_cache') == "1":
+        purge_expired_caches(cache_folder, cache_timeout())
+
+def main():
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if cache_folder:
+        serve(cache_folder)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+
+from remote_zip import is_remote_url, remote_stat
+
+ARCHIVES_FOLDER = 'archives'
+META_BASENAME = 'meta.json'
+RENDERED_FOLDER = 'rendered'
+BATCH_BASENAME = 'batch.json'
+VERIFIED_BASENAME = 'verified.json'
+DEFAULT_CACHE_MAX_MB = 500
+DEFAULT_CACHE_TIMEOUT = 300
+
+# ------------------------------ Archive fingerprints -------------------------------#
+
+def archive_fingerprint(zip_file):
+    # Identifies an archive by its path, size, modification time and inode, so that
+    # an unchanged archive is recognized and a modified or replaced one is not.
+    # A remote archive is identified by its URL, size and version
+    if is_remote_url(zip_file):
+        size, version = remote_stat(zip_file)
+        key = f"{zip_file}\0{size}\0{version}"
+    else:
+        st = os.stat(zip_file)
+        key = f"{os.path.realpath(zip_file)}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}"
+    return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()[:20]
+
+def nested_fingerprint(fingerprint, member):
+    # Identifies an archive stored as member of the archive with the given fingerprint
+    key = f"{fingerprint}\0{member}"
+    return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()[:20]
+
+def archive_cache_dir(cache_folder, fingerprint):
+    return os.path.join(cache_folder, ARCHIVES_FOLDER, fingerprint)
+
+def cache_max_bytes(variable='alzibro_cache_max_mb', default_mb=DEFAULT_CACHE_MAX_MB):
+    # Total budget of a cache, set in MB by a variable ('alzibro_cache_max_mb' for the archives)
+    try:
+        max_mb = float(os.getenv(variable) or default_mb)
+    except ValueError:
+        max_mb = default_mb
+    return int(max_mb * 1024 * 1024)
+
+def cache_timeout():
+    # Seconds without use after which an archive's cache expires, set by 'alzibro_cache_timeout'
+    try:
+        return float(os.getenv('alzibro_cache_timeout') or DEFAULT_CACHE_TIMEOUT)
+    except ValueError:
+        return DEFAULT_CACHE_TIMEOUT
+
+# ------------------------------ Cache entries -------------------------------#
+
+def create_cache_entry(entry_dir, zip_file, nested_path=None):
+    # Creates the folder of a cache entry along with a description of its archive
+    os.makedirs(entry_dir, exist_ok=True)
+    if is_remote_url(zip_file):
+        size, version = remote_stat(zip_file)
+        meta = {"zip_file": zip_file, "size": size, "version": version}
+    else:
+        st = os.stat(zip_file)
+        meta = {
+            "zip_file": os.path.realpath(zip_file),
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "inode": st.st_ino,
+        }
+    if nested_path:
+        meta["nested_path"] = nested_path
+    with open(os.path.join(entry_dir, META_BASENAME), 'w') as file:
+        json.dump(meta, file)
+
+def touch_cache_entry(entry_dir):
+    # The modification time of an entry's folder records its last use (for LRU eviction)
+    try:
+        os.utime(entry_dir)
+    except OSError:
+        pass
+
+def cache_entry_size(entry_dir):
+    if os.path.isfile(entry_dir):
+        return os.path.getsize(entry_dir)
+    total = 0
+    for root, dirs, files in os.walk(entry_dir):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def remove_cache_entry(entry_dir):
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir, ignore_errors=True)
+    else:
+        try:
+            os.remove(entry_dir)
+        except OSError:
+            pass
+
+def evict_lru_entries(folder, max_bytes, keep=None):
+    # Removes the least recently used entries of folder until their total size fits
+    # in max_bytes (the entry named keep, usually the one in use, is never removed)
+    try:
+        names = os.listdir(folder)
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        entry_dir = os.path.join(folder, name)
+        try:
+            last_used = os.stat(entry_dir).st_mtime
+        except OSError:
+            continue
+        entries.append((last_used, entry_dir, cache_entry_size(entry_dir)))
+
+    total = sum(size for _, _, size in entries)
+    for _, entry_dir, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        if os.path.basename(entry_dir) == keep:
+            continue
+        remove_cache_entry(entry_dir)
+        total -= size
+
+def evict_archive_caches(cache_folder, max_bytes, keep=None):
+    evict_lru_entries(os.path.join(cache_folder, ARCHIVES_FOLDER), max_bytes, keep)
+
+def purge_expired_caches(cache_folder, timeout):
+    # Removes the entries that were not used for more than timeout seconds.
+    # Called at the beginning of each invocation, so that no cleaner process is needed
+    archives_folder = os.path.join(cache_folder, ARCHIVES_FOLDER)
+    try:
+        names = os.listdir(archives_folder)
+    except OSError:
+        return
+    now = time.time()
+    for name in names:
+        entry_dir = os.path.join(archives_folder, name)
+        try:
+            last_used = os.stat(entry_dir).st_mtime
+        except OSError:
+            continue
+        if now - last_used > timeout:
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+# ------------------------------ Rendered responses -------------------------------#
+
+def rendered_response_file(entry_dir, directory, *options):
+    # The Alfred output for a folder of the archive, displayed with the given options
+    key = '\0'.join([directory] + [str(option) for option in options])
+    name = hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+    return os.path.join(entry_dir, RENDERED_FOLDER, name + '.json')
+
+def read_rendered_response(response_file):
+    try:
+        with open(response_file, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+def write_rendered_response(response_file, response):
+    # Failing to cache the output is not an error, it is only served slower next time
+    try:
+        os.makedirs(os.path.dirname(response_file), exist_ok=True)
+        temp_file = f"{response_file}.{os.getpid()}.tmp"
+        with open(temp_file, 'wb') as file:
+            file.write(response)
+        os.replace(temp_file, response_file)
+    except OSError:
+        pass
+
+def clear_rendered_responses(entry_dir):
+    shutil.rmtree(os.path.join(entry_dir, RENDERED_FOLDER), ignore_errors=True)
+
+# ------------------------------ Extraction batch -------------------------------#
+'''
+The batch of an archive lists the files and folders to extract together. They all belong
+to the same archive (the zip file itself, or the archive nested in it at "prefix").
+The batch is displayed in the listings, whose rendered responses are thus cleared
+whenever it changes.
+Every change also draws a new token: the listings hand it to the batch changes they
+offer, and a change is only applied if its token is the current one. Alfred keeps the
+variables of the last action, so that the same change reaches the script again at each
+keystroke or rerun: it is applied once only.
+'''
+
+def read_batch(entry_dir):
+    # Returns (prefix, members, token)
+    try:
+        with open(os.path.join(entry_dir, BATCH_BASENAME)) as file:
+            batch = json.load(file)
+        return batch["prefix"], batch["members"], batch["token"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return "", [], ""
+
+def write_batch(entry_dir, prefix, members):
+    os.makedirs(entry_dir, exist_ok=True)
+    batch_file = os.path.join(entry_dir, BATCH_BASENAME)
+    temp_file = f"{batch_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as file:
+        json.dump({"prefix": prefix, "members": members, "token": os.urandom(8).hex()}, file)
+    os.replace(temp_file, batch_file)
+    clear_rendered_responses(entry_dir)
+
+def clear_batch(entry_dir):
+    # Empties the batch (with a new token, so that no earlier change is applied again)
+    if os.path.exists(os.path.join(entry_dir, BATCH_BASENAME)):
+        write_batch(entry_dir, "", [])
+
+# ------------------------------ Verification results -------------------------------#
+'''
+The members of an archive whose CRC-32 was checked, each with the error met ("" if the
+member is intact). Nested members are recorded with their full path.
+'''
+
+def read_verification(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, VERIFIED_BASENAME)) as file:
+            results = json.load(file)
+        return results if isinstance(results, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+def write_verification(entry_dir, results):
+    os.makedirs(entry_dir, exist_ok=True)
+    verified_file = os.path.join(entry_dir, VERIFIED_BASENAME)
+    temp_file = f"{verified_file}.{os.getpid()}.tmp"
+    with open(temp_file, 'w') as file:
+        json.dump(results, file)
+    os.replace(temp_file, verified_file)
+
+# ------------------------------------- MAIN -------------------------------------#
+
+def main():
+    # A single cleanup pass, e.g. to be run by a scheduled task:
+    # python3 archive_cache.py [cache_folder]
+    cache_folder = sys.argv[1] if len(sys.argv) > 1 else os.getenv('alfred_workflow_cache')
+    if cache_folder:
+        purge_expired_caches(cache_folder, cache_timeout())
+
+if __name__ == "__main__":
+    main()
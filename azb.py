@@ -1,71 +1,105 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
-import json
-import zipfile
 import os
 import sys
-import subprocess
 
-from alfred import item_variables, enter_mods, base_item, selection_error_message, FOLDER_ICON
+# With the resident server enabled, hand the request over before importing anything heavy
+if __name__ == "__main__" and os.getenv('use_server') == "1":
+    from alzibro_client import forward_to_server
+    if forward_to_server('azb'):
+        sys.exit()
+
+import json
+import zipfile
+
+from alfred import item_variables, enter_mods, base_item, selection_error_message, format_size, \
+    FOLDER_ICON
+from archive_cache import archive_fingerprint, archive_cache_dir, create_cache_entry, \
+    touch_cache_entry, evict_archive_caches, cache_max_bytes, rendered_response_file, \
+    read_rendered_response, write_rendered_response, purge_expired_caches, cache_timeout, \
+    nested_fingerprint, read_batch, write_batch
+from zip_reader import read_zip_entries, read_zip_entry_count, info_entry, ZipReaderError
+from zip_index import parent_path, build_tree_index, list_directory, save_index, load_index, \
+    is_file_in_index, entry_path, is_file_entry
+from nested_zip import open_nested_archive, split_nested_path, is_archive_name
+from tar_archive import is_tar_name, read_tar_entries
+from remote_zip import open_archive_file
+from instrumentation import start_recording, finish_recording, phase, count
+from search_index import build_search_index, search_names, load_search_index
+from prewarm import prewarm_enabled, start_prewarm, prewarm_error
+
+DEFAULT_PAGE_SIZE = 500
+SEARCH_RESULTS_LIMIT = 100
+
+# Archives with more entries are indexed in the background (see prewarm.py), while the
+# first PARTIAL_ENTRIES are listed and Alfred reruns the script every RERUN_DELAY seconds
+PREWARM_MIN_ENTRIES = 20000
+PARTIAL_ENTRIES = 20000
+RERUN_DELAY = 0.5
+
+# Values of 'batch_action'
+ADD_TO_BATCH = "add"
+REMOVE_FROM_BATCH = "remove"
+CLEAR_BATCH = "clear"
+
+# Indexes parsed by this process, kept across requests by the resident server
+LOADED_INDEXES = {}
+MAX_LOADED_INDEXES = 8
 
 # ---------------------------------- Path functions -----------------------------------#
 
-def list_paths(zip_file):
+def list_entries(zip_file, nested_path=None):
+    # Returns the (path, size, compressed size, DOS time, CRC) of the members of the zip
+    # file. nested_path, if given, designates an archive nested in it (see nested_zip.py).
+    # Tar archives are read through their member index (see tar_archive.py)
     try:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            paths = zip_ref.namelist()
-            # In some rare cases, .namelist() generates paths with carriage returns
-            # --- better skip them
-            cleaned_paths = [p for p in paths if not "\r" in p]
-            return cleaned_paths
+        entries = None
+        if is_tar_name(zip_file):
+            entries = read_tar_entries(zip_file)
+        elif nested_path:
+            with open_nested_archive(zip_file, nested_path) as (zip_ref, _):
+                entries = [info_entry(info) for info in zip_ref.infolist()]
+        # Reads the entries directly from the central directory when possible
+        elif os.getenv('alzibro_fast_reader') != "0":
+            try:
+                entries = read_zip_entries(zip_file)
+            except ZipReaderError:
+                pass
+        if entries is None:
+            with open_archive_file(zip_file) as file, zipfile.ZipFile(file, 'r') as zip_ref:
+                entries = [info_entry(info) for info in zip_ref.infolist()]
+        # In some rare cases, .namelist() generates paths with carriage returns
+        # --- better skip them (newlines separate the members of a batch, see below)
+        cleaned_entries = [e for e in entries if not "\r" in e[0] and not "\n" in e[0]]
+        return cleaned_entries
     except Exception as e:
-        comment = f"Error when opening '{os.path.basename(zip_file)}'" 
+        comment = f"Error when opening '{os.path.basename(nested_path or zip_file)}'" 
         subcomment = str(e)
         selection_error_message(comment, subcomment)
         sys.exit()
 
-def sort_paths_by_depth_and_name(paths):
-    # sorts by depth, then directories first/files second, and then alphabetically
-    # (with files not beginning with '.' first)
-    return sorted(paths, key=lambda x: (x.count('/') - x.endswith('/'), not x.endswith('/'), 
-                    os.path.basename(x.rstrip('/')).startswith('.'),  x))
-
-def filter_macosx_paths(paths):
-    return [f for f in paths if not f.startswith('__MACOSX')]
-
-def filter_dsstore_paths(paths):
-    return [f for f in paths if '.DS_Store' not in f]
-
-def filter_directories_only(paths):
-    return [f for f in paths if f.endswith('/')]
-
-def filter_files_only(paths):
-    return [f for f in paths if not f.endswith('/')]
-
-def filter_paths_in_directory(paths, directory, show_subfolder_contents):
-    filtered_paths= [f for f in paths 
-        if f.startswith(directory)
-        and f != directory
-        and (f.lstrip(directory).rstrip('/').count('/') == 0 or show_subfolder_contents == "1")
-    ]
-    # Some ZIP files have files the main directory not listed in the namelist
-    if directory == "" and not filtered_paths:
-        filtered_paths= [f for f in paths 
-        if f.startswith(directory)
-        and f != directory
-        and (f.lstrip(directory).rstrip('/').count('/') == 1 or show_subfolder_contents == "1")
-    ]    
-    return filtered_paths
-
-def parent_path(my_path):
-    # gives the parent path to go to after ⇧↩ — with a particular form for short paths
-    my_path = my_path.rstrip('/')
-    parts = my_path.split('/')
-    if len(parts)<=1:
+# ------------------------------ Entry details -------------------------------#
+
+def format_dos_time(dos_time):
+    # DOS dates and times are local, with a two-second resolution
+    if dos_time == 0:
         return ""
-    else:
-        return '/'.join(parts[:-1]) +'/'
+    year, month, day = (dos_time >> 25) + 1980, (dos_time >> 21) & 0xF, (dos_time >> 16) & 0x1F
+    hour, minute = (dos_time >> 11) & 0x1F, (dos_time >> 5) & 0x3F
+    return f"{year}-{month:02d}-{day:02d} {hour:02d}:{minute:02d}"
+
+def entry_details(table, row):
+    # Size and date of a file, or total size and number of files of a folder,
+    # shown after its path in the subtitle
+    details = " · " + format_size(table["sizes"][row])
+    if not is_file_entry(table, row):
+        file_count = table["file_counts"][row]
+        return details + f" · {file_count} file" + ("s" if file_count != 1 else "")
+    date = format_dos_time(table["dos_times"][row])
+    if date:
+        details += " · " + date
+    return details
 
 # ------------------------------ JSON items makers -------------------------------#
 '''
@@ -75,17 +109,43 @@ For the following three add_to_JSON functions:
  current_directory = the folder that is currently under view
  my_path = the path for the file or folder under view (which may be in a subfolder)
  return_to_unzip = for a file, indicates if ↩ should directly extract it
+ details = the size (and date or number of files) displayed after the path
+ in_batch = indicates if the file or folder is in the batch to extract
 '''
 
-def add_folder_to_JSON(json_list, my_path, current_directory):
+def add_batch_mod(my_mods, my_path, current_directory, in_batch, batch_token):
+    # fn↩ adds the item to the batch of items to extract together, or removes it
+    action = REMOVE_FROM_BATCH if in_batch else ADD_TO_BATCH
+    variables = item_variables(current_directory, do_extraction=False, batch_member=my_path,
+                               batch_action=action, batch_token=batch_token)
+    if in_batch:
+        enter_mods("fn", "Remove from the batch to extract", variables, True, my_mods)
+    else:
+        enter_mods("fn", "Add to the batch to extract", variables, True, my_mods)
+
+def add_verify_mods(my_mods, my_path, current_directory, kind):
+    # ⌥↩ checks the CRC-32 of the item's files, ⌥⇧↩ those of the whole archive
+    variables = item_variables(current_directory, do_extraction=True, file_to_extract=my_path,
+                               verify=1)
+    enter_mods("alt", f"Verify the integrity of this {kind}", variables, True, my_mods)
+    variables = item_variables(current_directory, do_extraction=True, file_to_extract="", verify=1)
+    enter_mods("alt+shift", "Verify the integrity of the whole archive", variables, True, my_mods)
+
+def batch_title(title, in_batch):
+    return "☑ " + title if in_batch else title
+
+
+def add_folder_to_JSON(json_list, my_path, current_directory, details="", in_batch=False,
+                       batch_token="", verifiable=True):
     # JSON entry if the considered path corresponds to a nonempty folder
     
-    title = os.path.basename(my_path.rstrip('/'))
-    subtitle ="🗃/" + my_path
+    title = batch_title(os.path.basename(my_path.rstrip('/')), in_batch)
+    subtitle ="🗃/" + my_path + details
     icon = FOLDER_ICON
     variables = item_variables(my_path, do_extraction=False) 
     parent_directory = parent_path(current_directory)
-    hint="Hit ↩ to open the folder, ⇧↩ to go to the parent folder, ⌘↩ to unzip"
+    hint="Hit ↩ to open the folder, ⇧↩ to go to the parent folder, ⌘↩ to unzip, fn↩ to batch" \
+        + (", ⌥↩ to verify" if verifiable else "")
 
     new_item =  base_item(title, subtitle, variables, icon, is_valid=True)
 
@@ -94,8 +154,10 @@ def add_folder_to_JSON(json_list, my_path, current_directory):
     enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
     variables = item_variables(current_directory, do_extraction=True, file_to_extract=my_path)
     enter_mods("cmd", f"Extract this folder", variables, True, my_mods)
+    add_batch_mod(my_mods, my_path, current_directory, in_batch, batch_token)
+    if verifiable:
+        add_verify_mods(my_mods, my_path, current_directory, "folder")
     variables = item_variables("", do_extraction=False)
-    enter_mods("alt", hint, variables, False, my_mods)
     enter_mods("ctrl", hint, variables, False, my_mods)
 
     new_item.update({"mods" :my_mods})
@@ -105,11 +167,12 @@ def add_folder_to_JSON(json_list, my_path, current_directory):
 
 #--------------------
 
-def add_file_to_JSON(json_list, my_path, current_directory, return_to_unzip):
+def add_file_to_JSON(json_list, my_path, current_directory, return_to_unzip, details="",
+                     in_batch=False, batch_token="", verifiable=True):
     # JSON entry if the considered path corresponds to a file
 
-    title = os.path.basename(my_path)
-    subtitle ="🗃/" + my_path
+    title = batch_title(os.path.basename(my_path), in_batch)
+    subtitle ="🗃/" + my_path + details
     icon = "file_icon.png"
     if return_to_unzip == "1":
         do_extraction = True
@@ -117,10 +180,6 @@ def add_file_to_JSON(json_list, my_path, current_directory, return_to_unzip):
         do_extraction = False
     variables = item_variables(current_directory, do_extraction, my_path),
     parent_directory = parent_path(current_directory)
-    if return_to_unzip:
-        hint="Hit ⇧↩ to go to the parent folder, ↩ or ⌘↩ to unzip"
-    else:
-        hint="Hit ⇧↩ to go to the parent folder, ⌘↩ to unzip"
     
     new_item =  base_item(title, subtitle, variables, icon, is_valid=do_extraction)
 
@@ -131,8 +190,9 @@ def add_file_to_JSON(json_list, my_path, current_directory, return_to_unzip):
     enter_mods("cmd", f"Extract this file", variables, True, my_mods)
     variables = item_variables(current_directory, do_extraction=False, file_to_extract=my_path)
     enter_mods("ctrl", f"Take a Quicklook at this file", variables, True, my_mods)
-    variables = item_variables("", do_extraction=False)
-    enter_mods("alt", hint, variables, False, my_mods)
+    add_batch_mod(my_mods, my_path, current_directory, in_batch, batch_token)
+    if verifiable:
+        add_verify_mods(my_mods, my_path, current_directory, "file")
 
     new_item.update({"mods" :my_mods})
 
@@ -166,62 +226,424 @@ def JSON_if_empty_directory(json_list, current_directory):
     json_list["items"].append(new_item)
     return 
 
-#-------------------------------- ZIP & Cache  ----------------------------------#
+#--------------------
 
-def manage_cache_cleaner(cache_folder):
-    # If the cache cleaner process exists, renew its timeout, otherwise create it
-    cache_file = os.path.join(cache_folder, 'alzibro_cache')
-    cache_pid_file = os.path.join(cache_folder, 'cache_script.pid')
-    if os.path.isfile(cache_pid_file):
-        with open(cache_pid_file) as file:
-            pid = int(file.readline())
-    else:
-        pid=-1
-    # Check if this pid corresponds to alzibro_cache_cleaner
-    result = subprocess.run(
-        ["ps", "-p", str(pid), "-o", "command="],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.DEVNULL,
-        text=True,
-    )
-    if "alzibro_cache_cleaner" in result.stdout:
-        subprocess.Popen(f"kill -USR1 {pid} &", shell=True, 
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    else:
-        subprocess.Popen("zsh ./alzibro_cache_cleaner.sh &", shell=True, 
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-    return
+def JSON_if_no_match(json_list, current_directory, query):
+    # JSON entry if a search of the whole archive found nothing
+
+    title = f"No name matches '{query}'"
+    subtitle = "Hit ⇧↩ to go to the parent folder"
+    variables = item_variables(current_directory, False)
+    icon = "empty_set.png"
+    parent_directory = parent_path(current_directory)
+    hint = subtitle
+
+    new_item =  base_item(title, subtitle, variables, icon, is_valid=False)
+
+    my_mods = {}
+    variables = item_variables(parent_directory, do_extraction=False)
+    enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
+    variables = item_variables("", do_extraction=False)
+    enter_mods("alt", hint, variables, False, my_mods)
+    enter_mods("ctrl", hint, variables, False, my_mods)
+    enter_mods("cmd", hint, variables, False, my_mods)
+
+    new_item.update({"mods" :my_mods})
+
+    json_list["items"].append(new_item)
+    return 
 
 #--------------------
 
-def read_and_cache_zipfile(zip_file, cache_folder, cache_file):
-    # Reads the zip file, caches the paths in it in alzibro_cache_file,
-    # and returns a list of these paths
+def add_archive_to_JSON(json_list, my_path, current_directory, details="", in_batch=False,
+                        batch_token=""):
+    # JSON entry if the considered path corresponds to an archive nested in the zip file,
+    # which is opened as a folder
+
+    title = batch_title(os.path.basename(my_path), in_batch)
+    subtitle ="🗃/" + my_path + details
+    icon = "icon.png"
+    variables = item_variables(my_path + '/', do_extraction=False) 
+    parent_directory = parent_path(current_directory)
+
+    new_item =  base_item(title, subtitle, variables, icon, is_valid=True)
+
+    my_mods = {}
+    variables = item_variables(parent_directory, do_extraction=False)
+    enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
+    variables = item_variables(current_directory, do_extraction=True, file_to_extract=my_path)
+    enter_mods("cmd", f"Extract this archive", variables, True, my_mods)
+    variables = item_variables(current_directory, do_extraction=False, file_to_extract=my_path)
+    enter_mods("ctrl", f"Take a Quicklook at this archive", variables, True, my_mods)
+    add_batch_mod(my_mods, my_path, current_directory, in_batch, batch_token)
+    add_verify_mods(my_mods, my_path, current_directory, "archive")
+
+    new_item.update({"mods" :my_mods})
+
+    json_list["items"].append(new_item)
+    return 
+
+#--------------------
+
+def add_entries_to_JSON(json_list, table, rows, prefix, current_directory, return_to_unzip,
+                        batch=(), is_zip=True, batch_token="", folder_totals=True):
+    # JSON entries for rows of the entry table (files, folders and nested archives).
+    # prefix = the path of the nested archive the table belongs to, if any.
+    # is_zip = False (for a tar archive) lists the archives it contains as plain files,
+    # and offers no verification, as tar archives hold no CRCs.
+    # folder_totals = False leaves out the size and file count of the folders (when only
+    # some of the entries are known)
+    # batch_token = the token of the current batch, for the changes offered by fn↩
+    for row in rows:
+        my_path = prefix + entry_path(table, row)
+        details = entry_details(table, row)
+        if not folder_totals and not is_file_entry(table, row):
+            details = ""
+        in_batch = my_path in batch
+        if not is_file_entry(table, row):
+            add_folder_to_JSON(json_list, my_path, current_directory, details, in_batch,
+                               batch_token, is_zip)
+        elif is_zip and is_archive_name(my_path):
+            add_archive_to_JSON(json_list, my_path, current_directory, details, in_batch,
+                                batch_token)
+        else:
+            add_file_to_JSON(json_list, my_path, current_directory, return_to_unzip, details,
+                             in_batch, batch_token, is_zip)
+
+#--------------------
+
+def add_batch_to_JSON(json_list, batch, current_directory, batch_token):
+    # JSON entry to extract all the items of the batch at once
+
+    names = [os.path.basename(my_path.rstrip('/')) for my_path in batch]
+    title = f"Extract the {len(batch)} items of the batch" if len(batch) > 1 \
+        else "Extract the item of the batch"
+    subtitle = ", ".join(names)
+    # A newline after each member tells extract_from_zip.py that this is a batch
+    variables = item_variables(current_directory, do_extraction=True,
+                               file_to_extract=''.join(my_path + '\n' for my_path in batch))
+    icon = "icon.png"
+    parent_directory = parent_path(current_directory)
+    hint = "Hit ↩ to extract the batch, fn↩ to empty it, ⇧↩ to go to the parent folder"
+
+    new_item =  base_item(title, subtitle, variables, icon, is_valid=True)
+
+    my_mods = {}
+    variables = item_variables(parent_directory, do_extraction=False)
+    enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
+    variables = item_variables(current_directory, do_extraction=False,
+                               batch_action=CLEAR_BATCH, batch_token=batch_token)
+    enter_mods("fn", "Empty the batch", variables, True, my_mods)
+    variables = item_variables("", do_extraction=False)
+    enter_mods("alt", hint, variables, False, my_mods)
+    enter_mods("ctrl", hint, variables, False, my_mods)
+    enter_mods("cmd", hint, variables, False, my_mods)
+
+    new_item.update({"mods" :my_mods})
+
+    json_list["items"].append(new_item)
+    return 
+
+#--------------------
+
+def add_next_page_to_JSON(json_list, current_directory, next_offset, page_size, total):
+    # JSON entry to display the following items of a folder that does not fit in one page
+
+    count = min(page_size, total - next_offset)
+    title = f"Show next {count} items…"
+    subtitle = f"Items {next_offset + 1}–{next_offset + count} of {total}"
+    variables = item_variables(current_directory, do_extraction=False, page_offset=next_offset)
+    icon = "icon.png"
+    parent_directory = parent_path(current_directory)
+    hint = "Hit ↩ to show the next items, ⇧↩ to go to the parent folder"
+
+    new_item =  base_item(title, subtitle, variables, icon, is_valid=True)
+
+    my_mods = {}
+    variables = item_variables(parent_directory, do_extraction=False)
+    enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
+    variables = item_variables("", do_extraction=False)
+    enter_mods("alt", hint, variables, False, my_mods)
+    enter_mods("ctrl", hint, variables, False, my_mods)
+    enter_mods("cmd", hint, variables, False, my_mods)
+
+    new_item.update({"mods" :my_mods})
+
+    json_list["items"].append(new_item)
+    return 
+
+#--------------------
 
-    paths = list_paths(zip_file)
+def JSON_while_indexing(json_list, zip_file, listed, total, current_directory):
+    # JSON entry shown while a large archive is indexed in the background
+
+    title = f"Indexing '{os.path.basename(zip_file)}' ({total} entries)…"
+    subtitle = f"Only the first {listed} entries are listed, without folder sizes, until then"
+    variables = item_variables(current_directory, do_extraction=False)
+    icon = "icon.png"
+    parent_directory = parent_path(current_directory)
+    hint = subtitle
+
+    new_item =  base_item(title, subtitle, variables, icon, is_valid=False)
+
+    my_mods = {}
+    variables = item_variables(parent_directory, do_extraction=False)
+    enter_mods("shift", f"← Go to the parent folder", variables, True, my_mods)
+    variables = item_variables("", do_extraction=False)
+    enter_mods("alt", hint, variables, False, my_mods)
+    enter_mods("ctrl", hint, variables, False, my_mods)
+    enter_mods("cmd", hint, variables, False, my_mods)
+
+    new_item.update({"mods" :my_mods})
+
+    json_list["items"].append(new_item)
+    return 
+
+#-------------------------------- ZIP & Cache  ----------------------------------#
+
+def read_and_cache_zipfile(zip_file, entry_dir, index_file, nested_path=None):
+    # Reads the zip file (or an archive nested in it), caches its tree index in the
+    # archive's cache entry, and returns this index
+
+    with phase("read_zip"):
+        entries = list_entries(zip_file, nested_path)
+    count("archive_entries", len(entries))
+    with phase("build_index"):
+        index = build_tree_index(entries)
         
-    if not os.path.isdir(cache_folder):
+    try:
+        create_cache_entry(entry_dir, zip_file, nested_path)
+    except Exception as e:
+        comment = f"Error creating cache folder" 
+        subcomment = str(e)
+        selection_error_message(comment, subcomment)
+        sys.exit()
+    try:
+        with phase("save_index"):
+            save_index(index, index_file)
+    except Exception as e:
+        comment = f"Error writing cache file" 
+        subcomment = str(e)
+        selection_error_message(comment, subcomment)
+        sys.exit()
+
+    return index
+
+#--------------------
+
+def remember_index(key, index):
+    # Keeps the most recently used indexes in memory (useful to the resident server)
+    LOADED_INDEXES.pop(key, None)
+    LOADED_INDEXES[key] = index
+    while len(LOADED_INDEXES) > MAX_LOADED_INDEXES:
+        del LOADED_INDEXES[next(iter(LOADED_INDEXES))]
+
+#--------------------
+
+def get_cache_entry(zip_file, cache_folder):
+    # Returns the fingerprint of the zip file and the folder of its cache entry
+
+    try:
+        fingerprint = archive_fingerprint(zip_file)
+    except Exception as e:
+        comment = f"Error when opening '{os.path.basename(zip_file)}'" 
+        subcomment = str(e)
+        selection_error_message(comment, subcomment)
+        sys.exit()
+    return fingerprint, archive_cache_dir(cache_folder, fingerprint)
+
+#--------------------
+
+def get_archive_index(zip_file, cache_folder, fingerprint, entry_dir, nested_path=None):
+    # Returns the tree index of the zip file (or of an archive nested in it), reusing
+    # its cache entry if the archive is unchanged since it was indexed
+
+    index = LOADED_INDEXES.get(('index', fingerprint))
+    if index is not None:
+        return index
+
+    index_file = os.path.join(entry_dir, 'index')
+    try:
+        with phase("load_index"):
+            index = load_index(index_file)
+    except Exception:
+        index = read_and_cache_zipfile(zip_file, entry_dir, index_file, nested_path)
+        # Keep the whole cache within its budget
+        evict_archive_caches(cache_folder, cache_max_bytes(), keep=fingerprint)
+
+    remember_index(('index', fingerprint), index)
+    return index
+
+#--------------------
+
+def get_nested_index(zip_file, cache_folder, fingerprint, index, directory):
+    # If directory lies inside archives nested in the zip file, returns the index of the
+    # innermost one, the path of this archive followed by '/', and the directory inside it.
+    # Otherwise returns (index, "", directory)
+
+    if is_tar_name(zip_file):
+        return index, "", directory
+    prefix = ""
+    while True:
+        member, directory = split_nested_path(directory, lambda name: is_file_in_index(index, name))
+        if member is None:
+            return index, prefix, directory
+        prefix += member + '/'
+        fingerprint = nested_fingerprint(fingerprint, member)
+        entry_dir = archive_cache_dir(cache_folder, fingerprint)
+        touch_cache_entry(entry_dir)
+        index = get_archive_index(zip_file, cache_folder, fingerprint, entry_dir, prefix)
+
+#--------------------
+
+def get_search_index(zip_file, cache_folder, fingerprint, entry_dir):
+    # Returns the name search index of the zip file, built from its tree index on first use
+
+    search_index = LOADED_INDEXES.get(('search', fingerprint))
+    if search_index is not None:
+        return search_index
+
+    search_index_file = os.path.join(entry_dir, 'search_index')
+    try:
+        with phase("load_search_index"):
+            search_index = load_search_index(search_index_file)
+    except Exception:
+        index = get_archive_index(zip_file, cache_folder, fingerprint, entry_dir)
+        with phase("build_search_index"):
+            search_index = build_search_index(index)
         try:
-            os.mkdir(cache_folder)
-        except Exception as e:
-            comment = f"Error creating cache folder" 
-            subcomment = str(e)
-            selection_error_message(comment, subcomment)
-            sys.exit()
+            save_index(search_index, search_index_file)
+        except Exception:
+            pass
+
+    remember_index(('search', fingerprint), search_index)
+    return search_index
+
+#--------------------
+
+def update_batch(zip_file, cache_folder, fingerprint, entry_dir, member, action, token):
+    # Adds member to the batch of the zip file, removes it or empties the batch. A batch
+    # only holds items of one archive: an item of another (nested) archive starts a new
+    # batch. The change is only applied if token is the one of the current batch, as
+    # Alfred passes the same variables again at each keystroke and rerun
+
+    batch_prefix, batch, batch_token = read_batch(entry_dir)
+    if token != batch_token:
+        return
+    if action == CLEAR_BATCH:
+        batch = []
+    elif action in (ADD_TO_BATCH, REMOVE_FROM_BATCH) and member:
+        index = get_archive_index(zip_file, cache_folder, fingerprint, entry_dir)
+        _, prefix, _ = get_nested_index(zip_file, cache_folder, fingerprint, index,
+                                        parent_path(member))
+        if prefix != batch_prefix:
+            batch_prefix, batch = prefix, []
+        if action == REMOVE_FROM_BATCH and member in batch:
+            batch.remove(member)
+        elif action == ADD_TO_BATCH and member not in batch:
+            batch.append(member)
+    else:
+        return
     try:
-        with open(cache_file,'w') as file:
-            file.write('\n'.join(paths))
+        write_batch(entry_dir, batch_prefix, batch)
     except Exception as e:
         comment = f"Error writing cache file" 
         subcomment = str(e)
         selection_error_message(comment, subcomment)
         sys.exit()
 
-    return paths
+#--------------------
+
+def index_is_cached(fingerprint, entry_dir):
+    return ('index', fingerprint) in LOADED_INDEXES or os.path.exists(os.path.join(entry_dir, 'index'))
+
+def large_archive_entry_count(zip_file):
+    # The number of entries of the zip file if it is worth indexing in the background
+    try:
+        entry_count = read_zip_entry_count(zip_file)
+    except ZipReaderError:
+        return None
+    return entry_count if entry_count > PREWARM_MIN_ENTRIES else None
+
+#--------------------
+
+def get_page_size():
+    # Number of items displayed at once, set by the 'alzibro_page_size' variable
+    # (0 displays all the items of a folder)
+    try:
+        page_size = int(os.getenv('alzibro_page_size') or DEFAULT_PAGE_SIZE)
+    except ValueError:
+        page_size = DEFAULT_PAGE_SIZE
+    return page_size if page_size > 0 else None
+
+def get_listing_options():
+    # The variables changing how a folder is displayed, in the order of the
+    # arguments of rendered_response_file
+    return (os.getenv('show_subfolder_contents'), os.getenv('return_to_unzip_files'),
+            os.getenv('sort_by'), get_page_size())
+
+# ------------------------------------- Listings -------------------------------------#
+
+def render_folder(zip_file, cache_folder, fingerprint, entry_dir, index, current_directory,
+                  options, page_offset):
+    # Returns the Alfred output for a page of a folder of the zip file, whose tree index
+    # is given (the folder may lie in nested archives)
+
+    show_subfolder_contents, return_to_unzip, sort_by, page_size = options
+    with phase("nested_index"):
+        index, prefix, directory = get_nested_index(zip_file, cache_folder, fingerprint,
+                                                    index, current_directory)
+    
+    # Listing the requested page of the folder (the index is already filtered and sorted)
+    with phase("listing"):
+        sorted_rows, total = list_directory(index, directory, show_subfolder_contents,
+                                            page_offset, page_size, sort_by)
+    count("folder_entries", total)
+    count("items", len(sorted_rows))
+
+    resultJSON = {"items": []} 
+
+    # Generating the Alfred JSON output, with the batch to extract first if there is one
+    _, batch, batch_token = read_batch(entry_dir)
+    if batch and page_offset == 0:
+        add_batch_to_JSON(resultJSON, batch, current_directory, batch_token)
+    if sorted_rows:
+        with phase("items"):
+            add_entries_to_JSON(resultJSON, index["table"], sorted_rows, prefix,
+                                current_directory, return_to_unzip, set(batch),
+                                not is_tar_name(zip_file), batch_token)
+        next_offset = page_offset + len(sorted_rows)
+        if next_offset < total:
+            add_next_page_to_JSON(resultJSON, current_directory, next_offset, page_size, total)
+    else:
+        JSON_if_empty_directory(resultJSON, current_directory)
+    
+    with phase("serialize"):
+        return (json.dumps(resultJSON) + "\n").encode('utf-8')
+
+#--------------------
+
+def render_partial_folder(zip_file, entry_dir, entry_count, current_directory, options):
+    # Returns the Alfred output for a folder of a large zip file being indexed, from its
+    # first entries only, asking Alfred to run the script again shortly
+
+    show_subfolder_contents, return_to_unzip, sort_by, page_size = options
+    with phase("read_partial"):
+        entries = read_zip_entries(zip_file, PARTIAL_ENTRIES)
+        index = build_tree_index(entries)
+    sorted_rows, total = list_directory(index, current_directory, show_subfolder_contents,
+                                        0, page_size, sort_by)
+
+    _, batch, batch_token = read_batch(entry_dir)
+    resultJSON = {"rerun": RERUN_DELAY, "items": []}
+    JSON_while_indexing(resultJSON, zip_file, len(entries), entry_count, current_directory)
+    add_entries_to_JSON(resultJSON, index["table"], sorted_rows, "", current_directory,
+                        return_to_unzip, set(batch), batch_token=batch_token, folder_totals=False)
+    return (json.dumps(resultJSON) + "\n").encode('utf-8')
 
 # ------------------------------------- MAIN -------------------------------------#
 
-def main():
+def browse_zip_file():
 
     # Calling Variables
     starting = os.getenv('starting')
@@ -229,58 +651,104 @@ def main():
     if zip_file == None: zip_file=os.getenv('opened_zipfile')
     current_directory = os.getenv('next_directory')
     if not current_directory or current_directory == "/": current_directory = ""
-    return_to_unzip = os.getenv('return_to_unzip_files')
-    show_subfolder_contents = os.getenv('show_subfolder_contents')
+    options = get_listing_options()
+    return_to_unzip = options[1]
     cache_folder = os.getenv('alfred_workflow_cache')
-    cache_file = os.path.join(cache_folder, 'alzibro_cache')
     clear_cache = os.getenv('clear_cache')   
+    whole_archive_search = os.getenv('whole_archive_search')
+    batch_member = os.getenv('batch_member')
+    batch_action = os.getenv('batch_action')
+    batch_token = os.getenv('batch_token') or ""
+    query = sys.argv[1] if len(sys.argv) > 1 else ""
+    try:
+        page_offset = max(int(os.getenv('page_offset') or 0), 0)
+    except ValueError:
+        page_offset = 0
 
-    # Gathering the paths from either the zip file or the cache
-    if starting=="1":
-        paths = read_and_cache_zipfile(zip_file, cache_folder, cache_file)     
-    else:
-        try:
-            with open(cache_file,'r') as file:
-                paths = [line.rstrip() for line in file]
-        except Exception as e:
-            paths = read_and_cache_zipfile(cache_folder, cache_file)
+    with phase("fingerprint"):
+        fingerprint, entry_dir = get_cache_entry(zip_file, cache_folder)
 
-    # If the option is set, runs or resets the cache cleaner script
+    # If the option is set, forget the archives that were not used for a while
     if clear_cache == "1":
-        manage_cache_cleaner(cache_folder)
-    
-    # Filtering and sorting the paths
-    paths = filter_macosx_paths(paths)
-    paths = filter_dsstore_paths(paths)
-    paths = filter_paths_in_directory(paths, current_directory, show_subfolder_contents)
-
-    if show_subfolder_contents == "1":
-        all_paths = filter_directories_only(paths) + filter_files_only(paths)
-        sorted_paths = sort_paths_by_depth_and_name(all_paths)
-    else:
-        sorted_folder_paths = sort_paths_by_depth_and_name(filter_directories_only(paths))
-        sorted_file_paths = sort_paths_by_depth_and_name(filter_files_only(paths))
-        sorted_paths = sorted_folder_paths + sorted_file_paths
+        with phase("purge"):
+            purge_expired_caches(cache_folder, cache_timeout())
+    touch_cache_entry(entry_dir)
+
+    # Keep the whole cache within its budget when an archive is (re)opened
+    if starting == "1":
+        with phase("evict"):
+            evict_archive_caches(cache_folder, cache_max_bytes(), keep=fingerprint)
+
+    # Adding an item to the batch to extract (fn↩), or removing it
+    if batch_action:
+        update_batch(zip_file, cache_folder, fingerprint, entry_dir, batch_member, batch_action,
+                     batch_token)
+
+    # A large archive that is not indexed yet is indexed in the background: until then,
+    # its first entries are listed. If this failed, the error is displayed (without rerun)
+    if prewarm_enabled() and not index_is_cached(fingerprint, entry_dir):
+        entry_count = large_archive_entry_count(zip_file)
+        if entry_count is not None:
+            error = prewarm_error(entry_dir)
+            if error is not None:
+                selection_error_message(*error)
+                return
+            start_prewarm(entry_dir)
+            try:
+                response = render_partial_folder(zip_file, entry_dir, entry_count,
+                                                 current_directory, options)
+                sys.stdout.buffer.write(response)
+                return
+            except ZipReaderError:
+                pass
+
+    # Searching the whole archive by name, if the option is set and a query is typed
+    if whole_archive_search == "1" and query.strip():
+        search_index = get_search_index(zip_file, cache_folder, fingerprint, entry_dir)
+        with phase("search"):
+            rows = search_names(search_index, query, SEARCH_RESULTS_LIMIT)
+        count("items", len(rows))
+        _, batch, batch_token = read_batch(entry_dir)
+        resultJSON = {"items": []}
+        if batch:
+            add_batch_to_JSON(resultJSON, batch, current_directory, batch_token)
+        if rows:
+            add_entries_to_JSON(resultJSON, search_index["table"], rows, "", current_directory,
+                                return_to_unzip, set(batch), not is_tar_name(zip_file),
+                                batch_token)
+        else:
+            JSON_if_no_match(resultJSON, current_directory, query)
+        print(json.dumps(resultJSON))
+        return
+
+    # If this folder was already displayed with the same options, serve the same output
+    response_file = rendered_response_file(entry_dir, current_directory, *options, page_offset)
+    with phase("rendered_cache"):
+        response = read_rendered_response(response_file)
+    if response is not None:
+        sys.stdout.buffer.write(response)
+        return
+
+    # Gathering the tree index from either the cache or the zip file, and listing the folder
+    index = get_archive_index(zip_file, cache_folder, fingerprint, entry_dir)
+    response = render_folder(zip_file, cache_folder, fingerprint, entry_dir, index,
+                             current_directory, options, page_offset)
+    with phase("write"):
+        write_rendered_response(response_file, response)
+        sys.stdout.buffer.write(response)
+
+    # The first subfolders are prepared in the background when the archive is opened
+    if starting == "1" and prewarm_enabled():
+        start_prewarm(entry_dir)
 
-    resultJSON = {"items": []} 
+#--------------------
 
-    # If one wants to limit entries for speed purposes
-    # Set an environment variable 'alzibro_items_limit' and uncomment the two following lines
-    #
-    # alzibro_items_limit = int(os.getenv('alzibro_items_limit')) 
-    # sorted_paths = sorted_paths[:alzibro_items_limit]
-    
-    # Generating the Alfred JSON output
-    if sorted_paths:
-        for my_path in sorted_paths:
-            if my_path.endswith('/'):
-                add_folder_to_JSON(resultJSON, my_path, current_directory)
-            else:
-                add_file_to_JSON(resultJSON, my_path, current_directory, return_to_unzip)
-    else:
-        JSON_if_empty_directory(resultJSON, current_directory)
-    
-    print(json.dumps(resultJSON))
+def main():
+    start_recording('azb')
+    try:
+        browse_zip_file()
+    finally:
+        finish_recording()
 
 
 #--------------------
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Benchmarks of Alzibro on synthetic archives.
+
+    python3 benchmark.py run [--sizes 1000 10000 100000] [--shapes flat deep ...] [--out results.json]
+    python3 benchmark.py compare old.json new.json [--threshold 0.2]
+
+'run' generates archives of controlled shapes and sizes, and times the scripts as Alfred
+calls them (a fresh interpreter each time): first opening of the archive, navigation
+to a folder once the archive is indexed, subfolder-contents mode, extraction of a
+single file and extraction of a folder. The scripts run with background indexing off,
+so that each timing includes all its work; 'background_open' times the first opening
+with it, until the archive is indexed and pre-rendered. The median of several runs is
+reported as JSON.
+'compare' lists the timings of the second run that are slower than in the first one
+by more than the threshold, and exits with status 1 if there are some.
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from alfred import ALERT_ICON
+from prewarm import is_prewarming, PREWARM_ERROR
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+SHAPES = ["flat", "deep", "macosx", "unicode", "big_stored", "big_deflated"]
+DEFAULT_SIZES = [1000, 10000, 100000]
+BIG_FILE_SIZE = 64 * 1024 * 1024
+BIG_FILE_COUNT = 4
+PREWARM_POLL = 0.01
+PREWARM_TIMEOUT = 600
+
+class BenchmarkError(Exception):
+    pass
+
+# ---------------------------------- Archive generator -----------------------------------#
+
+def entry_names(shape, entries):
+    # Yields (name, is_metadata) for the entries of an archive of the given shape
+    for i in range(entries):
+        if shape == "deep":
+            # 7 levels of folders (all the digits but the last one), 10 subfolders each
+            digits = f"{i:08d}"
+            yield '/'.join(f"level{d}" for d in digits[:-1]) + f"/file{i}.txt", False
+        elif shape == "unicode":
+            yield f"dossier-été-{i % 50}/fichier très long {'日本語の名前' * 4} №{i}.txt", False
+        else:
+            yield f"folder{i % 100}/sub{i % 7}/file{i}.txt", False
+            if shape == "macosx":
+                yield f"__MACOSX/folder{i % 100}/sub{i % 7}/._file{i}.txt", True
+
+def generate_archive(zip_path, shape, entries):
+    # Returns the folder and the file used for the navigation and extraction timings
+    if shape in ("big_stored", "big_deflated"):
+        compression = zipfile.ZIP_STORED if shape == "big_stored" else zipfile.ZIP_DEFLATED
+        # Partly random data, so that deflate has some actual work to do
+        block = os.urandom(1024 * 1024 // 2) + bytes(1024 * 1024 // 2)
+        with zipfile.ZipFile(zip_path, 'w', compression=compression, allowZip64=True) as zip_ref:
+            for i in range(BIG_FILE_COUNT):
+                with zip_ref.open(f"big/file{i}.bin", 'w', force_zip64=True) as file:
+                    for _ in range(BIG_FILE_SIZE // len(block)):
+                        file.write(block)
+        return "big/", "big/file0.bin"
+
+    first_file = None
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        for name, is_metadata in entry_names(shape, entries):
+            zip_ref.writestr(name, b"meta" if is_metadata else name.encode('utf-8'))
+            if first_file is None:
+                first_file = name
+    return os.path.dirname(first_file) + '/', first_file
+
+# ---------------------------------- Timings -----------------------------------#
+
+def run_script(script, variables, cache_folder):
+    env = dict(os.environ)
+    env.update({"alfred_workflow_cache": cache_folder, "destination_folder": "",
+                "alzibro_prewarm": "0"})
+    env.update(variables)
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, os.path.join(SCRIPT_FOLDER, script)],
+                             cwd=SCRIPT_FOLDER, env=env, stdout=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    check_output(script, process)
+    return elapsed
+
+def check_output(script, process):
+    # A timing only counts if the script did its work: it exited normally, and wrote
+    # Alfred's JSON without any error
+    if process.returncode != 0:
+        raise BenchmarkError(f"{script} exited with status {process.returncode}")
+    try:
+        result = json.loads(process.stdout)
+    except ValueError:
+        raise BenchmarkError(f"{script} did not write JSON: {process.stdout[:200]!r}")
+    if "items" in result:
+        errors = [item for item in result["items"] if item.get("icon", {}).get("path") == ALERT_ICON]
+        if errors:
+            raise BenchmarkError(f"{script}: {errors[0]['title']} ({errors[0]['subtitle']})")
+    else:
+        # An extraction reveals what it extracted, unless it failed
+        variables = result["alfredworkflow"]["variables"]
+        if "reveal" not in variables:
+            raise BenchmarkError(f"{script}: {variables.get('comment')}")
+
+def time_background_open(zip_path, cache_folder):
+    # First opening with background indexing, until the index is written and the
+    # background process is done
+    start = time.perf_counter()
+    run_script("azb.py", {"zip_file": zip_path, "starting": "1", "alzibro_prewarm": "1"},
+               cache_folder)
+    archives_folder = os.path.join(cache_folder, 'archives')
+    while time.perf_counter() - start < PREWARM_TIMEOUT:
+        entry_dirs = [os.path.join(archives_folder, name) for name in os.listdir(archives_folder)]
+        for entry_dir in entry_dirs:
+            if os.path.exists(os.path.join(entry_dir, PREWARM_ERROR)):
+                raise BenchmarkError(f"Background indexing failed for {zip_path}")
+        if all(os.path.exists(os.path.join(entry_dir, 'index')) and not is_prewarming(entry_dir)
+               for entry_dir in entry_dirs):
+            return time.perf_counter() - start
+        time.sleep(PREWARM_POLL)
+    raise BenchmarkError(f"Background indexing took more than {PREWARM_TIMEOUT}s for {zip_path}")
+
+def clear_rendered_responses(cache_folder):
+    # Keeps the indexes but forgets the outputs, to time actual navigation
+    archives_folder = os.path.join(cache_folder, 'archives')
+    for name in os.listdir(archives_folder):
+        shutil.rmtree(os.path.join(archives_folder, name, 'rendered'), ignore_errors=True)
+
+def time_archive(zip_path, folder, file, repeat):
+    work_folder = tempfile.mkdtemp(prefix='alzibro-bench-')
+    cache_folder = os.path.join(work_folder, 'cache')
+    base = {"zip_file": zip_path}
+    timings = {"first_open": [], "background_open": [], "warm_navigation": [],
+               "subfolder_contents": [], "extract_file": [], "extract_folder": []}
+    try:
+        for _ in range(repeat):
+            shutil.rmtree(cache_folder, ignore_errors=True)
+            timings["background_open"].append(time_background_open(zip_path, cache_folder))
+            shutil.rmtree(cache_folder, ignore_errors=True)
+            timings["first_open"].append(run_script(
+                "azb.py", dict(base, starting="1"), cache_folder))
+            clear_rendered_responses(cache_folder)
+            timings["warm_navigation"].append(run_script(
+                "azb.py", dict(base, next_directory=folder), cache_folder))
+            clear_rendered_responses(cache_folder)
+            timings["subfolder_contents"].append(run_script(
+                "azb.py", dict(base, show_subfolder_contents="1"), cache_folder))
+
+            # Extractions are written next to the archive, and removed after each run
+            for key, to_extract in (("extract_file", file), ("extract_folder", folder)):
+                timings[key].append(run_script("extract_from_zip.py",
+                    dict(base, file_to_extract=to_extract, next_directory=""), cache_folder))
+                extracted = os.path.join(os.path.dirname(zip_path),
+                                         os.path.basename(to_extract.rstrip('/')))
+                if os.path.isdir(extracted):
+                    shutil.rmtree(extracted)
+                elif os.path.exists(extracted):
+                    os.remove(extracted)
+    finally:
+        shutil.rmtree(work_folder, ignore_errors=True)
+    return {key: statistics.median(values) for key, values in timings.items()}
+
+def run_benchmarks(shapes, sizes, repeat):
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='alzibro-archives-') as archive_folder:
+        for shape in shapes:
+            # The size of the big files does not depend on the number of entries
+            shape_sizes = [BIG_FILE_COUNT] if shape.startswith("big") else sizes
+            for entries in shape_sizes:
+                name = f"{shape}-{entries}"
+                zip_path = os.path.join(archive_folder, name + '.zip')
+                folder, file = generate_archive(zip_path, shape, entries)
+                results[name] = time_archive(zip_path, folder, file, repeat)
+                print(name, json.dumps(results[name]), file=sys.stderr)
+                os.remove(zip_path)
+    return {"python": sys.version.split()[0], "repeat": repeat, "results": results}
+
+#--------------------
+
+def compare_results(old, new, threshold):
+    # Returns the timings of new slower than those of old by more than threshold
+    regressions = []
+    for name, timings in new["results"].items():
+        for key, value in timings.items():
+            reference = old["results"].get(name, {}).get(key)
+            if reference and value > reference * (1 + threshold):
+                regressions.append((name, key, reference, value))
+    return regressions
+
+# ------------------------------------- MAIN -------------------------------------#
+
+def main():
+    parser = argparse.ArgumentParser(description="Alzibro benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run")
+    run.add_argument("--shapes", nargs="+", choices=SHAPES, default=SHAPES)
+    run.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    run.add_argument("--repeat", type=int, default=3)
+    run.add_argument("--out")
+    compare = commands.add_parser("compare")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        results = run_benchmarks(args.shapes, args.sizes, args.repeat)
+        output = json.dumps(results, indent=2)
+        if args.out:
+            with open(args.out, 'w') as file:
+                file.write(output)
+        else:
+            print(output)
+        return
+
+    with open(args.old) as file:
+        old = json.load(file)
+    with open(args.new) as file:
+        new = json.load(file)
+    regressions = compare_results(old, new, args.threshold)
+    for name, key, reference, value in regressions:
+        print(f"{name} {key}: {reference:.3f}s -> {value:.3f}s (+{value / reference - 1:.0%})")
+    sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,32 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
-import zipfile
 import os
+import sys
+
+# With the resident server enabled, hand the request over before importing anything heavy
+if __name__ == "__main__" and os.getenv('use_server') == "1":
+    from alzibro_client import forward_to_server
+    if forward_to_server('extract'):
+        sys.exit()
+
 import json
 import shutil
+import zipfile
 import tempfile
 import subprocess
-from alfred import alfred_error_message, outcome_JSON
+import contextlib
+from alfred import alfred_error_message, outcome_JSON, format_size
+from zip_extract import extract_members, macosx_sidecar, extraction_size, member_names, \
+    verify_members
+from nested_zip import open_nested_archive
+from archive_cache import archive_fingerprint, archive_cache_dir, clear_batch, read_verification, \
+    write_verification
+from remote_zip import is_remote_url
+from instrumentation import start_recording, finish_recording, phase, count
+
+REMOTE_DESTINATION = '~/Downloads'
+MAX_LISTED_CORRUPT = 5
 
 def notify_and_reveal(comment, next_directory, to_extract, destination_folder, zip_file):
     
@@ -15,126 +34,360 @@ def notify_and_reveal(comment, next_directory, to_extract, destination_folder, z
     ResultJSON = outcome_JSON(next_directory, comment, zip_file, to_reveal=reveal)
     print(json.dumps(ResultJSON))    
 
+def get_destination_folder(zip_directory):
+    # The user's destination folder, or the folder of the zip file if none is set
+    destination_folder = os.getenv('destination_folder')
+    if not destination_folder:
+        return zip_directory
+    return os.path.expanduser(destination_folder)
+
+def available_name(destination_folder, base_extraction_name):
+    # Changes the final name of the extraction if a file with the same name already exists
+    # in the destination folder: 'name-1', 'name-2', ... (before the extension for files)
+    new_extraction_name = base_extraction_name
+    new_extraction_path = os.path.join(destination_folder, new_extraction_name)
+    i = 0
+    if os.path.isfile(new_extraction_path):
+        name, ext = os.path.splitext(new_extraction_name)
+        while os.path.exists(new_extraction_path):
+            i += 1
+            new_extraction_name = f"{name}-{i}{ext}"
+            new_extraction_path = os.path.join(destination_folder, new_extraction_name)
+    else:
+        name = new_extraction_name
+        while os.path.exists(new_extraction_path):
+            i += 1
+            new_extraction_name = f"{name}-{i}"
+            new_extraction_path = os.path.join(destination_folder, new_extraction_name)
+    return new_extraction_name
+
+def incorporate_metadata(staging_dir, extraction_folder):
+    # Puts the extracted AppleDouble '._' files next to their files, and lets dot_clean
+    # merge them into the files' extended attributes, all within the staging folder.
+    # Returns False if this failed, after removing the '._' files copied next to the files
+    macosx_folder = os.path.join(staging_dir, '__MACOSX')
+    if not os.path.exists(macosx_folder):
+        return True
+    try:
+        subprocess.run(['rsync', '-a', macosx_folder + '/', extraction_folder + '/'],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(['dot_clean', '--keep=dotbar', extraction_folder],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+    except Exception:
+        remove_sidecars(macosx_folder, extraction_folder)
+        return False
+
+def remove_sidecars(macosx_folder, extraction_folder):
+    # Removes from extraction_folder the '._' files of macosx_folder, so that they do not
+    # end up in the extraction
+    for folder, _, files in os.walk(macosx_folder):
+        relative_folder = os.path.relpath(folder, macosx_folder)
+        for file in files:
+            if not file.startswith('._'):
+                continue
+            try:
+                os.remove(os.path.join(extraction_folder, relative_folder, file))
+            except OSError:
+                pass
+
+def prepare_staging(zip_file, next_directory):
+    # Returns the destination folder, and a hidden staging folder inside it in which the
+    # extraction is written before being renamed into place (None, None after an error)
+
+    if not is_remote_url(zip_file) and not os.path.isfile(zip_file):
+        comment = f"Error: the file '{zip_file}' was not found."
+        alfred_error_message(comment, next_directory, zip_file)
+        return None, None
+
+    # Determine the destination folder (the Downloads folder by default for a remote archive)
+    zip_directory = os.path.expanduser(REMOTE_DESTINATION) if is_remote_url(zip_file) \
+        else os.path.dirname(zip_file)
+    destination_folder = get_destination_folder(zip_directory)
+    if not os.path.isdir(destination_folder):
+        comment = f'Folder {destination_folder} is not recognized as a folder.' 
+        alfred_error_message(comment, next_directory, zip_file)
+        return None, None
+
+    try:
+        staging = tempfile.TemporaryDirectory(dir=destination_folder, prefix='.alzibro-')
+    except Exception as e:
+        comment = "Error: " + str(e)
+        alfred_error_message(comment, next_directory, zip_file)
+        return None, None
+    return destination_folder, staging
+
+def extraction_jobs(zip_ref, files_to_extract, staging_dir, extraction_folder):
+    # The members to extract, together with the associated metadata if there are some
+    all_names = set(zip_ref.namelist())
+    jobs = [(file, extraction_folder) for file in files_to_extract]
+    jobs += [(macosx_sidecar(file), staging_dir) for file in files_to_extract
+             if macosx_sidecar(file) in all_names]
+    count("members", len(jobs))
+    return jobs
+
+def space_error(zip_ref, jobs, label, destination_folder):
+    # Better not start an extraction that cannot fit in the destination folder
+    needed = extraction_size(zip_ref, jobs)
+    free = shutil.disk_usage(destination_folder).free
+    if needed > free:
+        return f"Error: {label} needs {format_size(needed)}, but only {format_size(free)} " \
+            "are free in the destination folder."
+    return None
+
+#--------------------
+
 def extract_folder_from_zip(zip_file, to_extract, next_directory):
     '''
      zip_file = the processed .zip file 
      to_extract = the file of folder to extract
      next_directory = the folder to be visited afterwards if Alzibro is not closed after extraction
+
+    to_extract may lie inside archives nested in the zip file (see nested_zip.py).
+    The extraction is written in a hidden staging folder inside the destination folder,
+    and then renamed into place, so that no data is copied across filesystems.
     '''
 
-    if not os.path.isfile(zip_file):
-        comment = f"Error: the file '{zip_file}' was not found."
-        alfred_error_message(comment, next_directory, zip_file)
+    zip_name = os.path.splitext(os.path.basename(zip_file))[0]
+    destination_folder, staging = prepare_staging(zip_file, next_directory)
+    if staging is None:
         return
 
-    zip_directory, zip_name = os.path.split(zip_file)
-    zip_name = os.path.splitext(zip_name)[0]
+    with staging as staging_dir, contextlib.ExitStack() as stack:
+        with phase("open"):
+            zip_ref, inner_path = stack.enter_context(open_nested_archive(zip_file, to_extract))
+            files_to_extract = [f for f in zip_ref.namelist() if f.startswith(inner_path)]
+        if not files_to_extract:
+            comment = f"Error: the path '{to_extract}' was not found in the archive."
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+        
+        # Extraction, together with the associated metadata if there are some
+        extraction_folder = os.path.join(staging_dir, zip_name)
+        jobs = extraction_jobs(zip_ref, files_to_extract, staging_dir, extraction_folder)
+        comment = space_error(zip_ref, jobs, f"'{os.path.basename(os.path.normpath(to_extract))}'",
+                              destination_folder)
+        if comment:
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+        try:
+            with phase("extract"):
+                extract_members(zip_ref, jobs)
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
 
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-            files_to_extract = [f for f in zip_ref.namelist() if f.startswith(to_extract)]
-            if not files_to_extract:
-                comment = f"Error: the path '{to_extract}' was not found in the ZIP file."
-                alfred_error_message(comment, next_directory, zip_file)
-                return
-            
-            # Extraction
-            output_folder = os.path.join(temp_dir, to_extract)
-            
-            for file in files_to_extract:
-                my_dir = os.path.dirname(file.rstrip('/'))
-                zip_ref.extract(file, temp_dir + '/' + zip_name + '/')
-                
-                # If there was associated metadata, retrieve them            
-                if my_dir == "":
-                    macosx_weird_file = '__MACOSX/'+ my_dir \
-                                        + '._' + os.path.basename(file)
-                else:
-                    macosx_weird_file = '__MACOSX/'+ my_dir \
-                                        + '/._' + os.path.basename(file)
-                try:
-                    zip_ref.extract(macosx_weird_file, temp_dir)
-                except:
-                    pass
-
-            # If there was associated metadata, tries to incorporate them
-            if os.path.exists(temp_dir + '/__MACOSX/'):
-                extracted_archive_path = os.path.join(temp_dir, zip_name)
-                try:
-                    shell_command = 'rsync -a ' + extracted_archive_path + '/ ' + temp_dir + '/__MACOSX/'
-                    subprocess.run(shell_command, cwd=temp_dir, shell=True, check=True)
-                    shell_command = 'dot_clean -v --keep=dotbar ' + extracted_archive_path + ' __MACOSX/'
-                    subprocess.run(shell_command, cwd=temp_dir, shell=True, check=True)
-                    extraction_folder = temp_dir + '/__MACOSX/'
-                    metadata_retrival_failed = False
-                except:
-                    metadata_retrival_failed = True
-                    extraction_folder = os.path.join(temp_dir, zip_name)    
-            else:
-                metadata_retrival_failed = False
-                extraction_folder = os.path.join(temp_dir, zip_name)
-
-            extraction_path = os.path.join(extraction_folder, to_extract)
-
-            # Determine the destination folder
-            destination_folder = os.getenv('destination_folder')
-            if destination_folder == "":
-                destination_folder = zip_directory
-            else:
-                destination_folder = os.path.expanduser(destination_folder)
-                if not os.path.isdir(destination_folder):
-                    comment = f'Folder {destination_folder} is not recognized as a folder.' 
-                    alfred_error_message(comment, next_directory, zip_file)
-                    return
-            
-            # Change the final name of the extraction if a file with the same name already exists
-            # in the destination folder
-            base_extraction_name = os.path.basename(os.path.normpath(to_extract))
-            new_extraction_name = base_extraction_name
+        # If there was associated metadata, tries to incorporate them
+        with phase("metadata"):
+            metadata_retrival_failed = not incorporate_metadata(staging_dir, extraction_folder)
 
-            new_extraction_path = os.path.join(destination_folder, new_extraction_name)
-            i = 0
-            if os.path.isfile(new_extraction_path):
-                name, ext = os.path.splitext(new_extraction_name)
-                while os.path.exists(new_extraction_path):
-                    i += 1
-                    new_extraction_name = f"{name}-{i}{ext}"
-                    new_extraction_path = os.path.join(destination_folder, new_extraction_name)
-            else:
-                name = new_extraction_name
-                while os.path.exists(new_extraction_path):
-                    i += 1
-                    new_extraction_name = f"{name}-{i}"
-                    new_extraction_path = os.path.join(destination_folder, new_extraction_name)
-            
-            if i>0:
-                shutil.move(extraction_path, os.path.join(extraction_folder, new_extraction_name))
-                extraction_path = os.path.join(extraction_folder, new_extraction_name)
-            
-            # Move the extracted file/folder to the user's destination and prepare the notification
-            try:
-                shutil.move(extraction_path, destination_folder)
-                
-                if i ==0:
-                    comment = f"'{base_extraction_name}' was successfully extracted from '{zip_name}.zip'." 
-                else:
-                    comment = f"'{base_extraction_name}' existed in destination folder and was " \
-                        f"extracted from '{zip_name}.zip' as '{new_extraction_name}'."
-                
-                if metadata_retrival_failed: comment = comment + " However metadata could not be retrieved."
-
-                notify_and_reveal(comment, next_directory, new_extraction_name, destination_folder, zip_file)
-
-            except Exception as e:
-                comment = "Error: " + str(e)
-                alfred_error_message(comment, next_directory, zip_file)
-                return
+        extraction_path = os.path.join(extraction_folder, inner_path)
+        base_extraction_name = os.path.basename(os.path.normpath(to_extract))
+        new_extraction_name = available_name(destination_folder, base_extraction_name)
+        
+        # Rename the extracted file/folder into the user's destination and prepare the notification
+        try:
+            with phase("rename"):
+                os.rename(extraction_path, os.path.join(destination_folder, new_extraction_name))
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+    if new_extraction_name == base_extraction_name:
+        comment = f"'{base_extraction_name}' was successfully extracted from '{os.path.basename(zip_file)}'." 
+    else:
+        comment = f"'{base_extraction_name}' existed in destination folder and was " \
+            f"extracted from '{os.path.basename(zip_file)}' as '{new_extraction_name}'."
+    
+    if metadata_retrival_failed: comment = comment + " However metadata could not be retrieved."
+
+    notify_and_reveal(comment, next_directory, new_extraction_name, destination_folder, zip_file)
             
+#--------------------
+
+def outside_other_folders(members):
+    # Drops the members lying in a folder that is also to be extracted
+    folders = [member for member in members if member.endswith('/')]
+    return [member for member in members
+            if not any(member != folder and member.startswith(folder) for folder in folders)]
+
+def extract_batch_from_zip(zip_file, members, next_directory):
+    '''
+     members = the files and folders of the batch, which all belong to the same archive
+     (the zip file itself or an archive nested in it)
+
+    The archive is opened once, the members are found by bisection in its sorted names,
+    extracted together into the same staging folder, and then renamed into place one by one.
+    '''
+
+    zip_name = os.path.splitext(os.path.basename(zip_file))[0]
+    destination_folder, staging = prepare_staging(zip_file, next_directory)
+    if staging is None:
+        return
+    members = outside_other_folders(list(dict.fromkeys(members)))
+
+    with staging as staging_dir, contextlib.ExitStack() as stack:
+        with phase("open"):
+            zip_ref, inner_path = stack.enter_context(open_nested_archive(zip_file, members[0]))
+            prefix = members[0][:len(members[0]) - len(inner_path)]
+            sorted_names = sorted(zip_ref.namelist())
+            found, files_to_extract = [], []
+            for member in members:
+                names = member_names(sorted_names, member[len(prefix):]) \
+                    if member.startswith(prefix) else []
+                if names:
+                    found.append(member[len(prefix):])
+                    files_to_extract += names
+        if not found:
+            comment = "Error: the items of the batch were not found in the archive."
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+        extraction_folder = os.path.join(staging_dir, zip_name)
+        jobs = extraction_jobs(zip_ref, files_to_extract, staging_dir, extraction_folder)
+        comment = space_error(zip_ref, jobs, "the batch", destination_folder)
+        if comment:
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+        try:
+            with phase("extract"):
+                extract_members(zip_ref, jobs)
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+        with phase("metadata"):
+            metadata_retrival_failed = not incorporate_metadata(staging_dir, extraction_folder)
+
+        # Rename every extracted file/folder into the user's destination
+        new_names, renamed = [], 0
+        try:
+            with phase("rename"):
+                for member in found:
+                    base_extraction_name = os.path.basename(os.path.normpath(member))
+                    new_extraction_name = available_name(destination_folder, base_extraction_name)
+                    os.rename(os.path.join(extraction_folder, member),
+                              os.path.join(destination_folder, new_extraction_name))
+                    new_names.append(new_extraction_name)
+                    renamed += new_extraction_name != base_extraction_name
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+    # The batch is done
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if cache_folder:
+        clear_batch(archive_cache_dir(cache_folder, archive_fingerprint(zip_file)))
+
+    comment = f"{len(found)} items were successfully extracted from '{os.path.basename(zip_file)}'."
+    if renamed:
+        comment += f" {renamed} of them already existed in the destination folder and got a new name."
+    if len(found) < len(members):
+        comment += f" {len(members) - len(found)} could not be found in the archive."
+    if metadata_retrival_failed: comment = comment + " However metadata could not be retrieved."
+
+    notify_and_reveal(comment, next_directory, new_names[0], destination_folder, zip_file)
+
+#--------------------
+
+def verification_comment(label, results):
+    # Summary of the verification of the files of label
+    corrupt = [member for member, error in results.items() if error]
+    if not corrupt:
+        if len(results) == 1:
+            return f"{label} is intact."
+        return f"The {len(results)} files of {label} are intact."
+    if len(results) == 1:
+        return f"{label} is corrupt ({results[corrupt[0]]})."
+    names = ", ".join(f"'{os.path.basename(member)}'" for member in corrupt[:MAX_LISTED_CORRUPT])
+    if len(corrupt) > MAX_LISTED_CORRUPT:
+        names += f" and {len(corrupt) - MAX_LISTED_CORRUPT} more"
+    verb = "is" if len(corrupt) == 1 else "are"
+    return f"{len(corrupt)} of the {len(results)} files of {label} {verb} corrupt: {names}."
+
+def verify_in_zip(zip_file, to_verify, next_directory):
+    '''
+     to_verify = the file or folder to verify ("" for the whole archive)
+
+    The CRC-32 of every file it contains is checked, on several cores for large amounts
+    of data. The results are kept in the archive's cache entry, so that later verifications
+    only read the members never verified before.
+    '''
+
+    label = f"'{os.path.basename(os.path.normpath(to_verify))}'" if to_verify \
+        else f"'{os.path.basename(zip_file)}'"
+    cache_folder = os.getenv('alfred_workflow_cache')
+
+    with contextlib.ExitStack() as stack:
+        try:
+            with phase("open"):
+                entry_dir = archive_cache_dir(cache_folder, archive_fingerprint(zip_file))
+                known_results = read_verification(entry_dir)
+                zip_ref, inner_path = stack.enter_context(open_nested_archive(zip_file, to_verify))
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+        if not isinstance(zip_ref, zipfile.ZipFile):
+            comment = "Error: only ZIP archives hold checksums of their files."
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+        # The files designated by to_verify, in the innermost archive
+        prefix = to_verify[:len(to_verify) - len(inner_path)]
+        names = sorted(zip_ref.namelist())
+        if inner_path:
+            names = member_names(names, inner_path)
+        members = [name for name in names if not name.endswith('/')]
+        if inner_path and not names:
+            comment = f"Error: the path '{to_verify}' was not found in the archive."
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+        unknown = [name for name in members if prefix + name not in known_results]
+        count("members", len(members))
+        count("verified", len(unknown))
+        try:
+            with phase("verify"):
+                new_results = verify_members(zip_ref, unknown)
+        except Exception as e:
+            comment = "Error: " + str(e)
+            alfred_error_message(comment, next_directory, zip_file)
+            return
+
+    # Not being able to keep the results only makes the next verification slower
+    if new_results:
+        known_results.update((prefix + name, error) for name, error in new_results.items())
+        try:
+            write_verification(entry_dir, known_results)
+        except OSError:
+            pass
+
+    results = {name: known_results[prefix + name] for name in members}
+    comment = verification_comment(label, results)
+    print(json.dumps(outcome_JSON(next_directory, comment, zip_file)))
+
+#--------------------
+
 def main():
     zip_file = os.getenv('zip_file')
     to_extract = os.getenv('file_to_extract')
     next_directory = os.getenv('next_directory')
-    extract_folder_from_zip(zip_file, to_extract, next_directory)
+    start_recording('extract')
+    try:
+        if os.getenv('verify') == "1":
+            verify_in_zip(zip_file, to_extract, next_directory)
+        # The members of a batch are each followed by a newline
+        elif '\n' in to_extract:
+            extract_batch_from_zip(zip_file, to_extract.split('\n')[:-1], next_directory)
+        else:
+            extract_folder_from_zip(zip_file, to_extract, next_directory)
+    finally:
+        finish_recording()
 
 if __name__ == "__main__":
     main()
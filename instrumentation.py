@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Opt-in timing of the scripts, enabled by setting the variable 'alzibro_profile' to 1.
+
+Each invocation of azb.py, extract_from_zip.py or quick_extract.py then appends one JSON
+line to alzibro_profile.log in the cache folder, with the wall time of its phases, some
+entry counts and its peak memory. The log is rotated once it exceeds MAX_LOG_BYTES.
+
+    python3 instrumentation.py [cache_folder]
+
+prints the percentiles of every phase of every script.
+'''
+import os
+import sys
+import json
+import time
+import resource
+import contextlib
+
+PROFILE_LOG = 'alzibro_profile.log'
+MAX_LOG_BYTES = 1024 * 1024
+
+# The record of the invocation being profiled (None when profiling is off)
+current_record = None
+
+# ---------------------------------- Recording -----------------------------------#
+
+def start_recording(script):
+    global current_record
+    current_record = None
+    if os.getenv('alzibro_profile') == "1":
+        current_record = {"script": script, "time": time.time(), "phases": {}, "counts": {},
+                          "start": time.perf_counter()}
+
+@contextlib.contextmanager
+def phase(name):
+    if current_record is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        phases = current_record["phases"]
+        phases[name] = phases.get(name, 0) + time.perf_counter() - start
+
+def count(name, value):
+    if current_record is not None:
+        current_record["counts"][name] = value
+
+def peak_memory():
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def finish_recording():
+    global current_record
+    record, current_record = current_record, None
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if record is None or not cache_folder:
+        return
+    record["total"] = time.perf_counter() - record.pop("start")
+    record["peak_memory"] = peak_memory()
+
+    # Profiling must never break the workflow
+    log_file = os.path.join(cache_folder, PROFILE_LOG)
+    try:
+        os.makedirs(cache_folder, exist_ok=True)
+        if os.path.isfile(log_file) and os.path.getsize(log_file) > MAX_LOG_BYTES:
+            os.replace(log_file, log_file + '.1')
+        with open(log_file, 'a') as file:
+            file.write(json.dumps(record) + '\n')
+    except OSError:
+        pass
+
+# ---------------------------------- Summary -----------------------------------#
+
+def read_records(cache_folder):
+    records = []
+    log_file = os.path.join(cache_folder, PROFILE_LOG)
+    for path in (log_file + '.1', log_file):
+        try:
+            with open(path) as file:
+                for line in file:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+    return records
+
+def percentile(sorted_values, p):
+    return sorted_values[min(int(p / 100 * len(sorted_values)), len(sorted_values) - 1)]
+
+def summarize(records):
+    # Returns lines describing the percentiles (in ms) of each phase of each script
+    timings = {}
+    for record in records:
+        phases = dict(record["phases"], total=record["total"])
+        for name, value in phases.items():
+            timings.setdefault((record["script"], name), []).append(value)
+
+    lines = [f"{'script':<12} {'phase':<20} {'count':>6} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}"]
+    for (script, name), values in sorted(timings.items()):
+        values.sort()
+        cells = [percentile(values, p) * 1000 for p in (50, 90, 99)] + [values[-1] * 1000]
+        lines.append(f"{script:<12} {name:<20} {len(values):>6} "
+                     + ' '.join(f"{cell:>9.1f}" for cell in cells))
+    return lines
+
+def main():
+    cache_folder = sys.argv[1] if len(sys.argv) > 1 else os.getenv('alfred_workflow_cache')
+    if not cache_folder:
+        print("Usage: python3 instrumentation.py cache_folder")
+        sys.exit(1)
+    records = read_records(cache_folder)
+    if not records:
+        print(f"No profile found in {cache_folder}")
+        return
+    for line in summarize(records):
+        print(line)
+    peak = max(record["peak_memory"] for record in records)
+    print(f"Peak memory: {peak / 1024 / 1024:.1f} MB")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Archives nested in other archives.
+
+A '.zip' member is browsed as a folder: "docs/inner.zip/sub/file.txt" designates the
+member "sub/file.txt" of the archive stored as "docs/inner.zip" in the outer archive.
+Nested archives are read without being extracted to disk: STORED ones through a view
+on the byte range they occupy in their parent, deflated ones through a buffer kept in
+memory up to MAX_IN_MEMORY bytes and spilled to a temporary file beyond.
+'''
+import io
+import shutil
+import zipfile
+import tempfile
+import contextlib
+
+from zip_extract import member_data_offset
+from tar_archive import is_tar_name, TarArchive
+from remote_zip import open_archive_file
+
+ARCHIVE_SUFFIX = '.zip'
+MAX_IN_MEMORY = 64 * 1024 * 1024
+
+# ---------------------------------- Nested paths -----------------------------------#
+
+def is_archive_name(my_path):
+    return not my_path.endswith('/') and my_path.lower().endswith(ARCHIVE_SUFFIX)
+
+def split_nested_path(my_path, is_file_member):
+    # Splits my_path into (archive member, path inside it) at the first '.zip/' whose
+    # prefix is a file of the current archive, or returns (None, my_path)
+    lower_path = my_path.lower()
+    start = 0
+    while True:
+        i = lower_path.find(ARCHIVE_SUFFIX + '/', start)
+        if i < 0:
+            return None, my_path
+        member = my_path[:i + len(ARCHIVE_SUFFIX)]
+        if is_file_member(member):
+            return member, my_path[i + len(ARCHIVE_SUFFIX) + 1:]
+        start = i + 1
+
+# ---------------------------------- Member views -----------------------------------#
+
+class MemberSlice(io.RawIOBase):
+    # Read-only view of the bytes [offset, offset + size) of a seekable file
+
+    def __init__(self, file, offset, size):
+        self.file = file
+        self.offset = offset
+        self.size = size
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        if position < 0:
+            raise OSError("Negative seek position")
+        self.position = position
+        return self.position
+
+    def readinto(self, buffer):
+        count = max(min(len(buffer), self.size - self.position), 0)
+        if count == 0:
+            return 0
+        self.file.seek(self.offset + self.position)
+        data = self.file.read(count)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+def is_file_member(zip_ref, name):
+    try:
+        return not zip_ref.getinfo(name).is_dir()
+    except KeyError:
+        return False
+
+@contextlib.contextmanager
+def open_member_archive(zip_ref, member):
+    # Opens the archive stored as member of zip_ref
+    info = zip_ref.getinfo(member)
+    with contextlib.ExitStack() as stack:
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            offset = member_data_offset(zip_ref.fp, info)
+            buffer = io.BufferedReader(MemberSlice(zip_ref.fp, offset, info.file_size))
+        else:
+            buffer = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=MAX_IN_MEMORY))
+            with zip_ref.open(info) as source:
+                shutil.copyfileobj(source, buffer, 1024 * 1024)
+            buffer.seek(0)
+        yield stack.enter_context(zipfile.ZipFile(buffer, 'r'))
+
+@contextlib.contextmanager
+def open_nested_archive(zip_file, my_path):
+    # Opens zip_file and the archives nested along my_path, and yields the innermost
+    # archive together with the rest of the path inside it. Archives in tar archives are
+    # not browsed
+    with contextlib.ExitStack() as stack:
+        if is_tar_name(zip_file):
+            yield stack.enter_context(TarArchive(zip_file)), my_path
+            return
+        file = stack.enter_context(open_archive_file(zip_file))
+        zip_ref = stack.enter_context(zipfile.ZipFile(file, 'r'))
+        while True:
+            member, my_path = split_nested_path(my_path, lambda name: is_file_member(zip_ref, name))
+            if member is None:
+                break
+            zip_ref = stack.enter_context(open_member_archive(zip_ref, member))
+        yield zip_ref, my_path
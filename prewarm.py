@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Background indexing and pre-rendering of an archive.
+
+azb.py starts this script, detached, when an archive is opened. It indexes the archive
+if it is not indexed yet (for a large archive, azb.py meanwhile lists its first entries
+and asks Alfred to rerun it until the index is ready), and then renders the listings of
+the root and of its first subfolders, so that the first ↩ are served from the cache.
+The variables of the opening (zip file, display options...) are inherited from azb.py.
+Only one of these processes works on a given archive at a time. If the indexing fails,
+the error is kept in the cache entry, for azb.py to display it instead of waiting.
+'''
+import io
+import os
+import sys
+import json
+import time
+import fcntl
+import contextlib
+import subprocess
+
+PREWARM_LOCK = 'prewarm.lock'
+PREWARM_ERROR = 'prewarm_error'
+# Written when the process is started, removed once it holds the lock: until then (or
+# for START_GRACE seconds if it never does), it is not started again
+PREWARM_START = 'prewarm.start'
+START_GRACE = 10
+MAX_PRERENDERED_FOLDERS = 20
+
+# ---------------------------------- Launching -----------------------------------#
+
+def prewarm_enabled():
+    # Set 'alzibro_prewarm' to 0 to do everything in the foreground
+    return os.getenv('alzibro_prewarm') != "0"
+
+def is_prewarming(entry_dir):
+    try:
+        with open(os.path.join(entry_dir, PREWARM_LOCK), 'r') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        pass
+    return False
+
+def prewarm_error(entry_dir):
+    # The (title, subtitle) of the error met when indexing in the background, or None
+    try:
+        with open(os.path.join(entry_dir, PREWARM_ERROR)) as file:
+            error = json.load(file)
+        return error["title"], error["subtitle"]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def write_prewarm_error(entry_dir, output, exception):
+    # azb.py reports errors as an Alfred item on the standard output before exiting
+    try:
+        title, subtitle = (json.loads(output)["items"][0][key] for key in ("title", "subtitle"))
+    except (ValueError, KeyError, IndexError, TypeError):
+        title, subtitle = "Error when indexing the archive", str(exception)
+    try:
+        with open(os.path.join(entry_dir, PREWARM_ERROR), 'w') as file:
+            json.dump({"title": title, "subtitle": subtitle}, file)
+    except OSError:
+        pass
+
+def start_prewarm(entry_dir):
+    # Starts the background process, unless it is running, was just started, or failed
+    if is_prewarming(entry_dir) or prewarm_error(entry_dir) is not None:
+        return
+    marker = os.path.join(entry_dir, PREWARM_START)
+    try:
+        if time.time() - os.path.getmtime(marker) < START_GRACE:
+            return
+    except OSError:
+        pass
+    script_folder = os.path.dirname(os.path.abspath(__file__))
+    try:
+        os.makedirs(entry_dir, exist_ok=True)
+        with open(marker, 'w'):
+            pass
+        subprocess.Popen([sys.executable, os.path.join(script_folder, 'prewarm.py')],
+            cwd=script_folder, start_new_session=True, stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError:
+        pass
+
+# ---------------------------------- Pre-warming -----------------------------------#
+
+def prewarm(zip_file, cache_folder):
+    # azb.py imports this module: imported here only
+    import azb
+    from archive_cache import rendered_response_file, write_rendered_response
+    from zip_index import entry_path, is_file_entry
+
+    fingerprint, entry_dir = azb.get_cache_entry(zip_file, cache_folder)
+    os.makedirs(entry_dir, exist_ok=True)
+    with open(os.path.join(entry_dir, PREWARM_LOCK), 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            # Already done by another process
+            return
+        try:
+            os.remove(os.path.join(entry_dir, PREWARM_START))
+        except OSError:
+            pass
+
+        output = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(output):
+                index = azb.get_archive_index(zip_file, cache_folder, fingerprint, entry_dir)
+        except (Exception, SystemExit) as e:
+            write_prewarm_error(entry_dir, output.getvalue(), e)
+            return
+
+        # The root, then its first subfolders, as they will be displayed
+        table = index["table"]
+        folders = [entry_path(table, row) for row in index["children"][""]
+                   if not is_file_entry(table, row)]
+        options = azb.get_listing_options()
+        for directory in [""] + folders[:MAX_PRERENDERED_FOLDERS]:
+            response_file = rendered_response_file(entry_dir, directory, *options, 0)
+            if os.path.exists(response_file):
+                continue
+            response = azb.render_folder(zip_file, cache_folder, fingerprint, entry_dir, index,
+                                         directory, options, 0)
+            write_rendered_response(response_file, response)
+
+# ------------------------------------- MAIN -------------------------------------#
+
+def main():
+    zip_file = os.getenv('zip_file') or os.getenv('opened_zipfile')
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if zip_file and cache_folder:
+        prewarm(zip_file, cache_folder)
+
+if __name__ == "__main__":
+    main()
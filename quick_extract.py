@@ -1,39 +1,136 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 #
-import zipfile
 import os
+import sys
+
+# With the resident server enabled, hand the request over before importing anything heavy
+if __name__ == "__main__" and os.getenv('use_server') == "1":
+    from alzibro_client import forward_to_server
+    if forward_to_server('quicklook'):
+        sys.exit()
+
 import json
 import shutil
+import hashlib
+import tempfile
+import contextlib
 
 from alfred import alfred_error_message, outcome_JSON, selection_error_message
+from archive_cache import archive_fingerprint, nested_fingerprint, archive_cache_dir, \
+    touch_cache_entry, evict_lru_entries, cache_max_bytes
+from zip_extract import extract_member, member_target_path
+from zip_index import load_index, find_entry, is_file_entry, is_file_in_index
+from nested_zip import open_nested_archive, split_nested_path
+from tar_archive import is_tar_name
+from instrumentation import start_recording, finish_recording, phase, count
+
+DEFAULT_QUICKLOOK_MAX_MB = 200
+
+def preview_key(fingerprint, to_extract, crc, file_size):
+    # Previews are identified by the archive's fingerprint and the member's name, CRC and size
+    key = f"{fingerprint}\0{to_extract}\0{crc}\0{file_size}"
+    return hashlib.sha1(key.encode('utf-8', 'surrogateescape')).hexdigest()
+
+def indexed_member(cache_folder, fingerprint, zip_file, to_extract):
+    # Returns (path inside the innermost archive, CRC, size) of the member from the cached
+    # indexes of the archive (and of the archives nested in it), or None if not indexed
+    my_path = to_extract
+    try:
+        while True:
+            index = load_index(os.path.join(archive_cache_dir(cache_folder, fingerprint), 'index'))
+            member, inner_path = None, my_path
+            if not is_tar_name(zip_file):
+                member, inner_path = split_nested_path(my_path,
+                                                       lambda name: is_file_in_index(index, name))
+            if member is None:
+                break
+            fingerprint, my_path = nested_fingerprint(fingerprint, member), inner_path
+    except Exception:
+        return None
+    table = index["table"]
+    row = find_entry(table, my_path)
+    if row is None or not is_file_entry(table, row):
+        return None
+    return my_path, table["crcs"][row], table["sizes"][row]
+
+def extract_preview(zip_ref, inner_path, preview_dir, temp_file):
+    # Extraction, in a staging folder renamed once complete. A preview folder without
+    # the file (left over by an interrupted preview) is replaced
+    if os.path.isdir(preview_dir):
+        shutil.rmtree(preview_dir, ignore_errors=True)
+    staging_dir = tempfile.mkdtemp(dir=os.path.dirname(preview_dir), prefix='.staging-')
+    try:
+        with phase("extract"):
+            extract_member(zip_ref, inner_path, staging_dir)
+        try:
+            os.rename(staging_dir, preview_dir)
+        except OSError:
+            # The same member was previewed meanwhile by another process
+            if not os.path.isfile(temp_file):
+                raise
+            shutil.rmtree(staging_dir, ignore_errors=True)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
 
 def temp_extract_and_quicklook(zip_file, to_extract, next_directory):
-    # Extracts a file in a temporary folder and takes a Quicklook at it
+    # Extracts a file in a temporary folder (unless it was already previewed)
+    # and takes a Quicklook at it
     
     cache_folder = os.getenv('alfred_workflow_cache')
     temp_dir = os.path.join(cache_folder, 'quicklook_files')
 
     if not os.path.isdir(temp_dir):
         try:
-            os.mkdir(temp_dir)
+            os.makedirs(temp_dir)
         except Exception as e:
             comment = f"Error creating quicklook files folder" 
             subcomment = str(e)
             selection_error_message(comment, subcomment)
             sys.exit()
 
-    # Extraction
-    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
-        try:
-            zip_ref.extract(to_extract, temp_dir)            
-        except Exception as e:
-            comment = "Error: " + str(e)
-            alfred_error_message(comment, next_directory, zip_file)
-            return
+    try:
+        fingerprint = archive_fingerprint(zip_file)
+
+        # A member already previewed is found from the cached index, without opening
+        # the archive
+        key = None
+        member = indexed_member(cache_folder, fingerprint, zip_file, to_extract)
+        if member is not None:
+            inner_path, crc, file_size = member
+            key = preview_key(fingerprint, to_extract, crc, file_size)
+            temp_file = member_target_path(inner_path, os.path.join(temp_dir, key))
+            if not os.path.isfile(temp_file):
+                key = None
+
+        if key is not None:
+            touch_cache_entry(os.path.join(temp_dir, key))
+        else:
+            with contextlib.ExitStack() as stack:
+                with phase("open"):
+                    zip_ref, inner_path = stack.enter_context(open_nested_archive(zip_file,
+                                                                                  to_extract))
+                info = zip_ref.getinfo(inner_path)
+                count("member_size", info.file_size)
+                key = preview_key(fingerprint, to_extract, info.CRC, info.file_size)
+                preview_dir = os.path.join(temp_dir, key)
+                temp_file = member_target_path(inner_path, preview_dir)
+                if os.path.isfile(temp_file):
+                    touch_cache_entry(preview_dir)
+                else:
+                    extract_preview(zip_ref, inner_path, preview_dir, temp_file)
+    except Exception as e:
+        comment = "Error: " + str(e)
+        alfred_error_message(comment, next_directory, zip_file)
+        return
+
+    # Keep the previews within their budget
+    with phase("evict"):
+        evict_lru_entries(temp_dir, cache_max_bytes('alzibro_quicklook_max_mb', DEFAULT_QUICKLOOK_MAX_MB),
+                          keep=key)
 
     # Quicklook with ql if possible, with qlmanage -p otherwise
-    temp_file = os.path.join(temp_dir, to_extract)
     
     # Pass variables to the External Call that reruns the workflow
     comment = ""
@@ -45,7 +142,11 @@ def main():
     zip_file = os.getenv('zip_file')
     to_extract = os.getenv('file_to_extract')
     next_directory = os.getenv('next_directory')
-    temp_extract_and_quicklook(zip_file, to_extract, next_directory)
+    start_recording('quicklook')
+    try:
+        temp_extract_and_quicklook(zip_file, to_extract, next_directory)
+    finally:
+        finish_recording()
 
 if __name__ == "__main__":
     main()
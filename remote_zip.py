@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Archives on a web server, read through HTTP range requests.
+
+zip_file may be an http:// or https:// URL: the archive is then never downloaded in
+full. Listing it fetches the end of the file (and the central directory if it lies
+before), and extracting a member fetches the bytes of this member only. Data is fetched
+by blocks of BLOCK_SIZE, and reading a member sequentially doubles the number of blocks
+fetched ahead at once up to MAX_REQUEST_BLOCKS. The blocks of short reads (directory,
+headers, small members) are also kept in the archive's cache entry, so that opening
+the archive again costs a single request; large members are not, as they are extracted
+anyway. Connections are kept open and reused between requests (and, with the resident
+server, between invocations). The size and version of an archive, which identify its
+cache entry, are kept for STAT_TTL seconds in the cache folder, so that the scripts
+called one after the other while browsing do not ask the server again.
+
+    python3 remote_zip.py [folder] [port]
+
+serves folder (the current one by default) with range support, as a stand-in for a
+web server to try remote archives locally.
+'''
+import io
+import os
+import re
+import sys
+import json
+import time
+import hashlib
+import http.client
+import http.server
+import urllib.parse
+
+REMOTE_SCHEMES = ('http://', 'https://')
+BLOCK_SIZE = 256 * 1024
+MAX_REQUEST_BLOCKS = 32
+MAX_MEMORY_BLOCKS = 2 * MAX_REQUEST_BLOCKS
+MAX_PERSISTED_RUN = 4
+BLOCKS_FOLDER = 'blocks'
+STATS_FOLDER = 'remote_stats'
+
+HTTP_TIMEOUT = 30
+MAX_REDIRECTS = 5
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+# How long the size and version of a remote archive are trusted without asking again
+STAT_TTL = 30
+
+# Idle connections per (scheme, host), and what is known of the remote archives
+IDLE_CONNECTIONS = {}
+REMOTE_STATS = {}
+
+class RemoteFileError(OSError):
+    pass
+
+def is_remote_url(zip_file):
+    return zip_file.lower().startswith(REMOTE_SCHEMES)
+
+# ---------------------------------- HTTP -----------------------------------#
+
+def get_connection(scheme, host):
+    idle = IDLE_CONNECTIONS.get((scheme, host))
+    if idle:
+        return idle.pop()
+    if scheme == 'https':
+        return http.client.HTTPSConnection(host, timeout=HTTP_TIMEOUT)
+    return http.client.HTTPConnection(host, timeout=HTTP_TIMEOUT)
+
+def release_connection(scheme, host, connection, response):
+    if response.will_close:
+        connection.close()
+    else:
+        IDLE_CONNECTIONS.setdefault((scheme, host), []).append(connection)
+
+def http_get_range(url, start, end):
+    # Fetches the bytes [start, end] of url, following redirects.
+    # Returns (final url, response, body)
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urllib.parse.urlsplit(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        # An idle connection may have been closed by the server meanwhile: one retry
+        for attempt in range(2):
+            connection = get_connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('GET', path, headers={"Range": f"bytes={start}-{end}"})
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                connection.close()
+                if attempt:
+                    raise RemoteFileError(f"Cannot reach {parts.netloc}: {e}")
+        release_connection(parts.scheme, parts.netloc, connection, response)
+        location = response.getheader('Location')
+        if response.status in REDIRECT_STATUSES and location:
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if response.status == 200:
+            raise RemoteFileError("The server does not support range requests")
+        if response.status != 206:
+            raise RemoteFileError(f"HTTP error {response.status} ({response.reason})")
+        return url, response, body
+    raise RemoteFileError("Too many redirects")
+
+def stat_file(url):
+    # Where the size and version of url are kept between invocations (None without cache)
+    cache_folder = os.getenv('alfred_workflow_cache')
+    if not cache_folder:
+        return None
+    key = hashlib.sha1(url.encode('utf-8', 'surrogateescape')).hexdigest()[:20]
+    return os.path.join(cache_folder, STATS_FOLDER, key + '.json')
+
+def read_stat_file(url):
+    # Returns the stat of url as kept in REMOTE_STATS, or None
+    try:
+        with open(stat_file(url)) as file:
+            stat = json.load(file)
+        return stat["checked"], stat["size"], stat["version"], stat["target_url"]
+    except (OSError, TypeError, ValueError, KeyError):
+        return None
+
+def write_stat_file(url, stat):
+    # Not being able to keep it only costs a request to the next invocation
+    path = stat_file(url)
+    if path is None:
+        return
+    checked, size, version, target_url = stat
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_file = f"{path}.{os.getpid()}.tmp"
+        with open(temp_file, 'w') as file:
+            json.dump({"checked": checked, "size": size, "version": version,
+                       "target_url": target_url}, file)
+        os.replace(temp_file, path)
+    except OSError:
+        pass
+
+def remote_stat(url):
+    # Returns (size, version) of the remote archive, the version being its ETag or
+    # its modification date
+    stat = REMOTE_STATS.get(url)
+    if stat is None or time.time() - stat[0] > STAT_TTL:
+        stat = read_stat_file(url)
+    if stat is None or time.time() - stat[0] > STAT_TTL:
+        target_url, response, _ = http_get_range(url, 0, 0)
+        match = re.fullmatch(r'bytes \d+-\d+/(\d+)', response.getheader('Content-Range') or "")
+        if not match:
+            raise RemoteFileError("The server did not give the size of the file")
+        size = int(match.group(1))
+        version = response.getheader('ETag') or response.getheader('Last-Modified') or ""
+        stat = (time.time(), size, version, target_url)
+        write_stat_file(url, stat)
+    REMOTE_STATS[url] = stat
+    return stat[1], stat[2]
+
+# ---------------------------------- Remote file -----------------------------------#
+
+class RemoteFile(io.RawIOBase):
+    # Read-only, seekable view of a remote file. blocks = the blocks in memory,
+    # block_dir = the folder in which blocks are kept (None to keep none)
+
+    def __init__(self, url, block_dir=None):
+        self.size, _ = remote_stat(url)
+        self.url = REMOTE_STATS[url][3]
+        self.block_dir = block_dir
+        self.blocks = {}
+        self.position = 0
+        self.next_position = None
+        self.read_ahead = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence == io.SEEK_END:
+            position += self.size
+        if position < 0:
+            raise OSError("Negative seek position")
+        self.position = position
+        return self.position
+
+    def block_file(self, block):
+        return os.path.join(self.block_dir, str(block))
+
+    def has_block(self, block):
+        # Loads the block from the disk if it is there
+        if block in self.blocks:
+            return True
+        if self.block_dir is None:
+            return False
+        try:
+            with open(self.block_file(block), 'rb') as file:
+                self.blocks[block] = file.read()
+            return True
+        except OSError:
+            return False
+
+    def save_block(self, block, data):
+        # Not being able to keep a block only makes the next reading slower
+        try:
+            os.makedirs(self.block_dir, exist_ok=True)
+            temp_file = self.block_file(block) + '.tmp'
+            with open(temp_file, 'wb') as file:
+                file.write(data)
+            os.replace(temp_file, self.block_file(block))
+        except OSError:
+            pass
+
+    def fetch_blocks(self, first, last):
+        # Fetches the blocks [first, last] in a single request
+        start = first * BLOCK_SIZE
+        end = min((last + 1) * BLOCK_SIZE, self.size) - 1
+        _, _, body = http_get_range(self.url, start, end)
+        if len(body) != end - start + 1:
+            raise RemoteFileError("Truncated response from the server")
+        persist = self.block_dir is not None and last - first < MAX_PERSISTED_RUN
+        for block in range(first, last + 1):
+            data = body[(block - first) * BLOCK_SIZE:(block - first + 1) * BLOCK_SIZE]
+            self.blocks[block] = data
+            if persist:
+                self.save_block(block, data)
+
+    def load_blocks(self, first, last):
+        # Makes sure the blocks [first, last] are in memory, fetching the missing ones
+        # (and some more if the file is read sequentially) with as few requests as possible
+        runs = []
+        for block in range(first, last + 1):
+            if self.has_block(block):
+                continue
+            if runs and runs[-1][1] == block - 1:
+                runs[-1][1] = block
+            else:
+                runs.append([block, block])
+        if runs and runs[-1][1] == last:
+            last_block = (self.size - 1) // BLOCK_SIZE
+            while (runs[-1][1] < min(last + self.read_ahead, last_block)
+                   and not self.has_block(runs[-1][1] + 1)):
+                runs[-1][1] += 1
+        for run_first, run_last in runs:
+            self.fetch_blocks(run_first, run_last)
+
+    def readinto(self, buffer):
+        end = min(self.position + len(buffer), self.size,
+                  self.position + MAX_REQUEST_BLOCKS * BLOCK_SIZE)
+        if self.position >= end:
+            return 0
+        if self.position == self.next_position:
+            self.read_ahead = min(max(2 * self.read_ahead, 1), MAX_REQUEST_BLOCKS)
+        else:
+            self.read_ahead = 0
+        self.next_position = end
+        first, last = self.position // BLOCK_SIZE, (end - 1) // BLOCK_SIZE
+        self.load_blocks(first, last)
+
+        data = b''.join(self.blocks[block] for block in range(first, last + 1))
+        start = self.position - first * BLOCK_SIZE
+        count = end - self.position
+        buffer[:count] = data[start:start + count]
+        self.position = end
+
+        # The oldest blocks leave the memory first
+        while len(self.blocks) > MAX_MEMORY_BLOCKS:
+            del self.blocks[next(iter(self.blocks))]
+        return count
+
+#--------------------
+
+def open_archive_file(zip_file):
+    # A binary file object reading the archive, be it local or remote
+    if not is_remote_url(zip_file):
+        return open(zip_file, 'rb')
+
+    # archive_cache imports this module: imported here only
+    from archive_cache import archive_fingerprint, archive_cache_dir
+    cache_folder = os.getenv('alfred_workflow_cache')
+    block_dir = None
+    if cache_folder:
+        block_dir = os.path.join(archive_cache_dir(cache_folder, archive_fingerprint(zip_file)),
+                                 BLOCKS_FOLDER)
+    return io.BufferedReader(RemoteFile(zip_file, block_dir), BLOCK_SIZE)
+
+# ---------------------------------- Local server -----------------------------------#
+
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    # http.server's file server, answering single range requests like web servers do
+    protocol_version = 'HTTP/1.1'
+
+    def send_head(self):
+        match = re.fullmatch(r'bytes=(\d*)-(\d*)', self.headers.get('Range') or "")
+        path = self.translate_path(self.path)
+        if not match or match.groups() == ("", "") or not os.path.isfile(path):
+            return super().send_head()
+
+        with open(path, 'rb') as file:
+            st = os.fstat(file.fileno())
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(int(last), st.st_size - 1) if last else st.st_size - 1
+            else:
+                start, end = max(st.st_size - int(last), 0), st.st_size - 1
+            if start > end:
+                self.send_error(416, "Range Not Satisfiable")
+                return None
+            file.seek(start)
+            data = file.read(end - start + 1)
+
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{end}/{st.st_size}")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        return io.BytesIO(data)
+
+def main():
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.getcwd()
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    handler = lambda *args: RangeRequestHandler(*args, directory=folder)
+    with http.server.ThreadingHTTPServer(('127.0.0.1', port), handler) as server:
+        print(f"Serving {folder} on http://127.0.0.1:{port}/")
+        server.serve_forever()
+
+if __name__ == "__main__":
+    main()
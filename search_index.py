@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+import heapq
+import pickle
+from array import array
+
+from zip_index import entry_path, entry_count, DEPTH_SHIFT
+
+SEARCH_INDEX_VERSION = 2
+# The columns of the entry table needed to display the results
+RESULT_COLUMNS = ("names", "offsets", "sizes", "file_counts", "dos_times", "sort_keys")
+
+# ---------------------------------- Gram index -----------------------------------#
+'''
+The search index maps every trigram and bigram of the (lowercased) base names of the
+archive's entries to the sorted array of the rows containing it. A query is answered by
+intersecting the arrays of its words' grams (the word itself for a two-letter word),
+checking the few remaining candidates, and ranking them: exact names first, then names
+beginning with the query, then the others. A query of single letters only checks every
+name, as most names would match anyway.
+The names are kept in a single string, much faster to load than a list of strings.
+The search index also holds the columns of the entry table that the results are
+displayed from, so that searching only loads this file.
+'''
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+def name_grams(name):
+    return trigrams(name) | {name[i:i+2] for i in range(len(name) - 1)}
+
+def word_grams(word):
+    return trigrams(word) if len(word) > 2 else {word} if len(word) == 2 else set()
+
+def build_search_index(index):
+    # Built from the tree index, so that hidden entries are not searchable either
+    table = index["table"]
+    names = [os.path.basename(entry_path(table, row).rstrip('/')).lower()
+             for row in range(entry_count(table))]
+    postings = {}
+    for row, name in enumerate(names):
+        for gram in name_grams(name):
+            rows = postings.get(gram)
+            if rows is None:
+                postings[gram] = array('I', [row])
+            else:
+                rows.append(row)
+    # Names are separated by newlines, which they never contain
+    return {"version": SEARCH_INDEX_VERSION,
+            "table": {column: table[column] for column in RESULT_COLUMNS},
+            "names": '\n'.join(names), "postings": postings}
+
+def search_names(search_index, query, limit):
+    # Returns the rows (in search_index["table"]) of the best (at most limit) entries
+    # whose names contain every word of the query
+    words = query.lower().split()
+    if not words:
+        return []
+    postings = search_index["postings"]
+    sort_keys = search_index["table"]["sort_keys"]
+
+    candidates = None
+    grams = set().union(*(word_grams(word) for word in words))
+    for gram in sorted(grams, key=lambda g: len(postings.get(g, ()))):
+        rows = postings.get(gram)
+        if rows is None:
+            return []
+        candidates = set(rows) if candidates is None else candidates.intersection(rows)
+        if not candidates:
+            return []
+    names = search_index["names"].split('\n')
+    # Single letters only
+    if candidates is None:
+        candidates = range(len(names))
+
+    # The rows are sorted by path: the row breaks ties as the path would
+    first_word = words[0]
+    def rank(row):
+        name = names[row]
+        return (name != first_word, not name.startswith(first_word), len(name),
+                sort_keys[row] >> DEPTH_SHIFT, row)
+
+    matches = (row for row in candidates if all(word in names[row] for word in words))
+    return heapq.nsmallest(limit, matches, key=rank)
+
+#--------------------
+
+def load_search_index(search_index_file):
+    with open(search_index_file, 'rb') as file:
+        search_index = pickle.load(file)
+    if not isinstance(search_index, dict) or search_index.get("version") != SEARCH_INDEX_VERSION:
+        raise ValueError("Outdated search index")
+    return search_index
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Tar archives (.tar, .tar.gz/.tgz and .tar.zst/.tzst).
+
+A tar archive has no central directory: it is read once from start to end to build an
+index of its members (name, kind, size, date and offset of the data in the uncompressed
+stream), which is kept in the archive's cache entry. Members are then read at their
+offset: directly for a plain tar, through a decompressing view for a compressed one.
+
+A gzip file can only be decompressed from the start of one of its gzip members, so the
+index records these starts as checkpoints: files written by bgzip, pigz --independent
+or by concatenation have many of them, and reading a member starts from the checkpoint
+preceding it. Python's zlib can neither save the state of a decompressor nor resume
+inflating at an arbitrary bit position, so the points inside a gzip member cannot be
+persisted: the decompressor is snapshotted every SNAPSHOT_SPACING bytes in memory only,
+for the later reads of the same process (the resident server). A plain .tar.gz made of
+a single gzip member (what tar -czf and gzip write) therefore gets no speedup across
+invocations: each script extracting from it decompresses it from the start up to the
+member.
+Reading .tar.zst archives needs the zstd support of Python 3.14, or the 'zstandard'
+module; they are decompressed from their start.
+
+TarArchive exposes a tar archive with the few methods of zipfile.ZipFile used by the
+other scripts (namelist, getinfo, extract).
+'''
+import io
+import os
+import time
+import zlib
+import pickle
+import tarfile
+import contextlib
+
+from archive_cache import archive_fingerprint, archive_cache_dir, create_cache_entry
+from zip_index import save_index
+from zip_extract import member_target_path, COPY_CHUNK_SIZE
+from remote_zip import open_archive_file
+
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+TAR_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst', '.tar.zstd', '.tzst')
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+TAR_INDEX_BASENAME = 'tar_index'
+TAR_INDEX_VERSION = 1
+
+INPUT_CHUNK_SIZE = 256 * 1024
+# In memory only (see above): without the resident server, a single-member .tar.gz is
+# decompressed from its start at each extraction
+SNAPSHOT_SPACING = 16 * 1024 * 1024
+
+# Indexes and decompressor snapshots of the archives read by this process
+LOADED_TAR_INDEXES = {}
+DECOMPRESSOR_SNAPSHOTS = {}
+MAX_LOADED_ARCHIVES = 4
+
+class TarArchiveError(Exception):
+    pass
+
+def is_tar_name(my_path):
+    return my_path.lower().endswith(TAR_SUFFIXES)
+
+def remember(cache, key, value):
+    # Keeps the data of the most recently used archives only
+    cache.pop(key, None)
+    cache[key] = value
+    while len(cache) > MAX_LOADED_ARCHIVES:
+        del cache[next(iter(cache))]
+
+# ---------------------------------- Gzip view -----------------------------------#
+
+class GzipStream(io.RawIOBase):
+    # Read-only, seekable view of the uncompressed contents of a gzip file.
+    # checkpoints = the (uncompressed, compressed) offsets of gzip member starts,
+    # snapshots = the (uncompressed, compressed offset, decompressor) taken so far;
+    # both lists are completed while reading
+
+    def __init__(self, file, checkpoints, snapshots):
+        self.file = file
+        self.checkpoints = checkpoints
+        self.snapshots = snapshots
+        self.position = 0
+        self.decompressor = None
+        self.output = b''
+        self.output_start = 0
+        self.input_position = 0
+        self.pending_input = b''
+        self.next_snapshot = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self.position
+        elif whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Can only seek from the start or the current position")
+        if position < 0:
+            raise OSError("Negative seek position")
+        self.position = position
+        return self.position
+
+    def restart_point(self, position):
+        # The closest point before position from which decompression can start
+        best = max((c for c in self.checkpoints if c[0] <= position), key=lambda c: c[0])
+        for snapshot in self.snapshots:
+            if best[0] < snapshot[0] <= position:
+                best = snapshot
+        return best
+
+    def restart(self, point):
+        if len(point) == 2:
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        else:
+            self.decompressor = point[2].copy()
+        self.output_start, self.input_position = point[0], point[1]
+        self.output = b''
+        self.pending_input = b''
+        self.next_snapshot = point[0] + SNAPSHOT_SPACING
+
+    def fill(self):
+        # Replaces the (consumed) output by the next decompressed bytes.
+        # Returns False at the end of the data
+        self.output_start += len(self.output)
+        self.output = b''
+        data = self.pending_input
+        if not data:
+            self.file.seek(self.input_position)
+            data = self.file.read(INPUT_CHUNK_SIZE)
+            if not data:
+                raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+            self.input_position += len(data)
+        self.output = self.decompressor.decompress(data, COPY_CHUNK_SIZE)
+        self.pending_input = self.decompressor.unconsumed_tail
+        output_end = self.output_start + len(self.output)
+
+        if self.decompressor.eof:
+            # Another gzip member may follow, anything else ends the data
+            self.pending_input = self.decompressor.unused_data
+            member_start = self.input_position - len(self.pending_input)
+            self.file.seek(member_start)
+            if self.file.read(len(GZIP_MAGIC)) != GZIP_MAGIC:
+                return bool(self.output)
+            if not any(c[0] == output_end for c in self.checkpoints):
+                self.checkpoints.append((output_end, member_start))
+            self.decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            self.next_snapshot = output_end + SNAPSHOT_SPACING
+        elif not self.pending_input and output_end >= self.next_snapshot:
+            # The decompressor has consumed exactly the input up to input_position
+            if not self.snapshots or self.snapshots[-1][0] < output_end:
+                self.snapshots.append((output_end, self.input_position, self.decompressor.copy()))
+            self.next_snapshot = output_end + SNAPSHOT_SPACING
+        return True
+
+    def readinto(self, buffer):
+        # Fills buffer up to the end of the data: tarfile reads each header in a single
+        # call, and takes a short read for the end of the archive
+        view = memoryview(buffer).cast('B')
+        total = 0
+        while total < len(view):
+            count = self.read_window(view[total:])
+            if not count:
+                break
+            total += count
+        return total
+
+    def read_window(self, buffer):
+        # Reads into buffer from the current window of decompressed data only
+        output_end = self.output_start + len(self.output)
+        if self.decompressor is None or self.position < self.output_start:
+            self.restart(self.restart_point(self.position))
+        else:
+            # Jumping forward to a checkpoint beats decompressing up to it
+            point = self.restart_point(self.position)
+            if point[0] > output_end:
+                self.restart(point)
+        while self.position >= self.output_start + len(self.output):
+            if self.decompressor.eof and not self.pending_input:
+                return 0
+            if not self.fill():
+                return 0
+        start = self.position - self.output_start
+        count = min(len(buffer), len(self.output) - start)
+        buffer[:count] = self.output[start:start + count]
+        self.position += count
+        return count
+
+#--------------------
+
+def detect_compression(file):
+    file.seek(0)
+    magic = file.read(len(ZSTD_MAGIC))
+    file.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return "gz"
+    if magic == ZSTD_MAGIC:
+        return "zst"
+    return ""
+
+def open_zstd(file):
+    if zstd is not None:
+        return zstd.ZstdFile(file)
+    if zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(file, read_across_frames=True)
+    raise TarArchiveError("Reading .tar.zst archives needs Python 3.14 or the 'zstandard' module")
+
+@contextlib.contextmanager
+def open_tar_stream(tar_file, tar_index):
+    # Yields a file object reading the uncompressed tar data of the archive
+    with open_archive_file(tar_file) as file:
+        compression = tar_index["compression"]
+        if compression == "gz":
+            snapshots = DECOMPRESSOR_SNAPSHOTS.get(tar_index["fingerprint"], [])
+            remember(DECOMPRESSOR_SNAPSHOTS, tar_index["fingerprint"], snapshots)
+            yield GzipStream(file, tar_index["checkpoints"], snapshots)
+        elif compression == "zst":
+            with open_zstd(file) as stream:
+                yield stream
+        else:
+            yield file
+
+# ---------------------------------- Index -----------------------------------#
+'''
+The tar index maps the name of each member (with a trailing '/' for directories, without
+any leading './') to (kind, offset of the data, size, mode, modification time, link
+target); "names" lists them in the order of the archive.
+'''
+
+def member_name(name):
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+def member_record(info):
+    if info.isdir():
+        kind = "dir"
+    elif info.isreg():
+        kind = "file"
+    elif info.issym():
+        kind = "symlink"
+    elif info.islnk():
+        kind = "hardlink"
+    else:
+        kind = "other"
+    linkname = member_name(info.linkname) if info.islnk() else info.linkname
+    return (kind, info.offset_data, info.size, info.mode, info.mtime, linkname)
+
+def index_tar(tar_file):
+    fingerprint = archive_fingerprint(tar_file)
+    with open_archive_file(tar_file) as file:
+        compression = detect_compression(file)
+    tar_index = {"version": TAR_INDEX_VERSION, "fingerprint": fingerprint,
+                 "compression": compression, "checkpoints": [(0, 0)], "members": {}}
+    members = tar_index["members"]
+    with open_tar_stream(tar_file, tar_index) as stream:
+        # A zstd stream can only be read forward
+        mode = 'r|' if compression == "zst" else 'r:'
+        with tarfile.open(fileobj=stream, mode=mode) as tar:
+            for info in tar:
+                name = member_name(info.name)
+                if not name or name == '.':
+                    continue
+                if info.isdir():
+                    name += '/'
+                # As when extracting, a later member replaces an earlier one
+                members.pop(name, None)
+                members[name] = member_record(info)
+    tar_index["names"] = list(members)
+    return tar_index
+
+def load_tar_index(index_file):
+    with open(index_file, 'rb') as file:
+        tar_index = pickle.load(file)
+    if not isinstance(tar_index, dict) or tar_index.get("version") != TAR_INDEX_VERSION:
+        raise ValueError("Outdated tar index")
+    return tar_index
+
+def get_tar_index(tar_file):
+    # The index of the archive, from its cache entry if it was already indexed
+    fingerprint = archive_fingerprint(tar_file)
+    tar_index = LOADED_TAR_INDEXES.get(fingerprint)
+    if tar_index is not None:
+        return tar_index
+
+    cache_folder = os.getenv('alfred_workflow_cache')
+    entry_dir = archive_cache_dir(cache_folder, fingerprint) if cache_folder else None
+    try:
+        tar_index = load_tar_index(os.path.join(entry_dir, TAR_INDEX_BASENAME))
+    except Exception:
+        tar_index = index_tar(tar_file)
+        # Not being able to cache the index only makes the next opening slower
+        if entry_dir:
+            try:
+                create_cache_entry(entry_dir, tar_file)
+                save_index(tar_index, os.path.join(entry_dir, TAR_INDEX_BASENAME))
+            except OSError:
+                pass
+    remember(LOADED_TAR_INDEXES, fingerprint, tar_index)
+    return tar_index
+
+#--------------------
+
+def dos_time(mtime):
+    # The DOS date and time of zip_reader's entries
+    year, month, day, hour, minute, second = time.localtime(mtime)[:6]
+    if year < 1980:
+        return 0
+    return ((year - 1980) << 9 | month << 5 | day) << 16 | hour << 11 | minute << 5 | second // 2
+
+def read_tar_entries(tar_file):
+    # The same (path, size, compressed size, DOS time, CRC) tuples as zip_reader's;
+    # tar archives have neither compressed sizes nor CRCs
+    tar_index = get_tar_index(tar_file)
+    entries = []
+    for name in tar_index["names"]:
+        kind, _, size, _, mtime, _ = tar_index["members"][name]
+        entries.append((name, size, size, dos_time(mtime), 0))
+    return entries
+
+# ---------------------------------- Archive -----------------------------------#
+
+class TarMemberInfo:
+    # The attributes of zipfile.ZipInfo used by the other scripts
+
+    def __init__(self, name, record):
+        self.filename = name
+        self.header_offset = record[1]
+        self.file_size = self.compress_size = record[2]
+        self.CRC = 0
+
+    def is_dir(self):
+        return self.filename.endswith('/')
+
+class TarArchive:
+    # A tar archive, read like a zipfile.ZipFile. Reading the members in the order of
+    # namelist() never goes backwards in the (compressed) data
+
+    def __init__(self, tar_file):
+        self.filename = tar_file
+        self.tar_index = get_tar_index(tar_file)
+        self.members = self.tar_index["members"]
+        self.stack = contextlib.ExitStack()
+        self.stream = self.stack.enter_context(open_tar_stream(tar_file, self.tar_index))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.stack.close()
+
+    def namelist(self):
+        return list(self.tar_index["names"])
+
+    def getinfo(self, name):
+        return TarMemberInfo(name, self.members[name])
+
+    def copy_data(self, record, target_path):
+        _, offset, size, mode, mtime, _ = record
+        self.stream.seek(offset)
+        with open(target_path, 'wb') as target:
+            remaining = size
+            while remaining > 0:
+                chunk = self.stream.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise tarfile.ReadError("Unexpected end of data")
+                target.write(chunk)
+                remaining -= len(chunk)
+        # Like tarfile's 'data' filter: no special bits, always readable by the user
+        os.chmod(target_path, mode & 0o755 | 0o600)
+        os.utime(target_path, (mtime, mtime))
+
+    def extract(self, member, path):
+        # Directories, files, hard links (as copies) and symbolic links pointing inside
+        # the extraction are extracted; devices and such are skipped
+        kind, _, _, _, _, linkname = record = self.members[member]
+        target_path = member_target_path(member, path)
+        if kind == "dir":
+            os.makedirs(target_path, exist_ok=True)
+            return target_path
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        if kind == "file":
+            self.copy_data(record, target_path)
+        elif kind == "hardlink" and self.members.get(linkname, ("",))[0] == "file":
+            self.copy_data(self.members[linkname], target_path)
+        elif kind == "symlink":
+            resolved = os.path.normpath(os.path.join(os.path.dirname(member), linkname))
+            if not os.path.isabs(linkname) and not resolved.startswith('..'):
+                os.symlink(linkname, target_path)
+        return target_path
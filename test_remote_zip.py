@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Tests of remote_zip against local archives, served by RangeRequestHandler.
+
+    python3 -m pytest test_remote_zip.py
+
+Listing and extracting a remote archive must give the same entries and the same bytes
+as the local file, with the blocks and the stat of the archive reused between openings.
+'''
+import os
+import zipfile
+import threading
+import http.server
+
+import pytest
+
+import remote_zip
+from remote_zip import RangeRequestHandler, RemoteFileError, open_archive_file, remote_stat
+from zip_reader import read_zip_entries
+
+BIG_MEMBER_SIZE = 6 * 1024 * 1024
+
+# ---------------------------------- Helpers -----------------------------------#
+
+class CountingHandler(RangeRequestHandler):
+    # Counts the requests, quietly
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append(self.headers.get('Range'))
+        super().do_GET()
+
+class NoRangeHandler(http.server.SimpleHTTPRequestHandler):
+    # A server answering range requests with the whole file
+    def log_message(self, *args):
+        pass
+
+def serve(folder, handler_class):
+    handler = lambda *args: handler_class(*args, directory=folder)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    # A zip with small and large, stored and deflated members, served over HTTP.
+    # Yields (local path, URL, list of requests)
+    folder = tmp_path / "served"
+    folder.mkdir()
+    zip_path = folder / "archive.zip"
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as zip_ref:
+        for i in range(200):
+            zip_ref.writestr(f"folder{i % 10}/file{i}.txt", f"contents of {i}\n" * (i + 1))
+        zip_ref.writestr("big/random.bin", os.urandom(BIG_MEMBER_SIZE))
+        zip_ref.writestr("big/stored.bin", os.urandom(BIG_MEMBER_SIZE // 3),
+                         compress_type=zipfile.ZIP_STORED)
+
+    monkeypatch.setenv('alfred_workflow_cache', str(tmp_path / "cache"))
+    monkeypatch.setattr(remote_zip, 'REMOTE_STATS', {})
+    monkeypatch.setattr(remote_zip, 'IDLE_CONNECTIONS', {})
+    CountingHandler.requests = []
+    server, base_url = serve(str(folder), CountingHandler)
+    yield str(zip_path), base_url + "/archive.zip", CountingHandler.requests
+    server.shutdown()
+    server.server_close()
+
+# ---------------------------------- Tests -----------------------------------#
+
+def test_listing_matches_local(archive):
+    zip_path, url, _ = archive
+    assert read_zip_entries(url) == read_zip_entries(zip_path)
+    with open_archive_file(url) as file, zipfile.ZipFile(file) as zip_ref:
+        with zipfile.ZipFile(zip_path) as local_ref:
+            assert zip_ref.namelist() == local_ref.namelist()
+
+def test_extraction_matches_local(archive):
+    zip_path, url, requests = archive
+    with open_archive_file(url) as file, zipfile.ZipFile(file) as zip_ref:
+        with zipfile.ZipFile(zip_path) as local_ref:
+            for name in local_ref.namelist():
+                assert zip_ref.read(name) == local_ref.read(name)
+    # Read-ahead: the big members are not fetched block by block
+    block_count = os.path.getsize(zip_path) // remote_zip.BLOCK_SIZE + 1
+    assert len(requests) < block_count
+
+def test_blocks_and_stat_are_reused(archive):
+    zip_path, url, requests = archive
+    read_zip_entries(url)
+    first_opening = len(requests)
+    # Another invocation: nothing in memory, the cache folder only
+    remote_zip.REMOTE_STATS.clear()
+    assert read_zip_entries(url) == read_zip_entries(zip_path)
+    assert len(requests) == first_opening
+
+def test_stat_expires(archive, monkeypatch):
+    zip_path, url, requests = archive
+    assert remote_stat(url)[0] == os.path.getsize(zip_path)
+    assert remote_stat(url)[0] == os.path.getsize(zip_path)
+    assert len(requests) == 1
+    monkeypatch.setattr(remote_zip, 'STAT_TTL', -1)
+    remote_stat(url)
+    assert len(requests) == 2
+
+def test_range_errors(archive):
+    _, url, _ = archive
+    with pytest.raises(RemoteFileError):
+        remote_stat(url.replace("archive.zip", "missing.zip"))
+
+    server, base_url = serve(os.path.dirname(archive[0]), NoRangeHandler)
+    try:
+        with pytest.raises(RemoteFileError, match="range requests"):
+            remote_stat(base_url + "/archive.zip")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Reading past the end of the file
+    with open_archive_file(url) as file:
+        file.seek(0, os.SEEK_END)
+        assert file.read(10) == b""
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Tests of tar_archive against tarfile, on generated .tar.gz archives.
+
+    python3 -m pytest test_tar_archive.py
+
+index_tar and TarArchive must list the same members as tarfile.open(...).getnames(),
+and read the same bytes, whether the gzip file is made of many members (as written by
+bgzip or pigz --independent) or of a single one.
+'''
+import io
+import os
+import gzip
+import random
+import tarfile
+
+import pytest
+
+from tar_archive import index_tar, member_name, TarArchive
+
+MEMBER_COUNT = 3000
+GZIP_MEMBER_SIZE = 100000
+
+# ---------------------------------- Helpers -----------------------------------#
+
+def tar_data():
+    # Many small members of random (incompressible) data, so that the headers fall
+    # anywhere in the windows of decompressed data
+    rng = random.Random(1)
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w') as tar:
+        for i in range(MEMBER_COUNT):
+            data = rng.randbytes(rng.randint(100, 3000))
+            info = tarfile.TarInfo(f"folder{i % 5}/file{i}.bin")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+@pytest.fixture(scope="module")
+def archives(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("tars")
+    data = tar_data()
+    multi = folder / "multi.tar.gz"
+    with open(multi, 'wb') as file:
+        for start in range(0, len(data), GZIP_MEMBER_SIZE):
+            file.write(gzip.compress(data[start:start + GZIP_MEMBER_SIZE]))
+    single = folder / "single.tar.gz"
+    single.write_bytes(gzip.compress(data))
+    return {"multi": str(multi), "single": str(single)}
+
+# ---------------------------------- Tests -----------------------------------#
+
+@pytest.mark.parametrize("kind", ["multi", "single"])
+def test_same_members_as_tarfile(archives, kind, monkeypatch):
+    monkeypatch.delenv('alfred_workflow_cache', raising=False)
+    tar_file = archives[kind]
+    with tarfile.open(tar_file) as tar:
+        expected = [member_name(name) for name in tar.getnames()]
+    assert index_tar(tar_file)["names"] == expected
+    with TarArchive(tar_file) as archive:
+        assert archive.namelist() == expected
+
+@pytest.mark.parametrize("kind", ["multi", "single"])
+def test_same_data_as_tarfile(archives, kind, monkeypatch, tmp_path):
+    monkeypatch.delenv('alfred_workflow_cache', raising=False)
+    tar_file = archives[kind]
+    with tarfile.open(tar_file) as tar, TarArchive(tar_file) as archive:
+        # In the order of the archive, then backwards
+        names = archive.namelist()[::97]
+        for name in names + names[::-1]:
+            target_path = archive.extract(name, str(tmp_path))
+            with open(target_path, 'rb') as file:
+                assert file.read() == tar.extractfile(name).read()
+            os.remove(target_path)
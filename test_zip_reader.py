@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+Tests of zip_reader against zipfile, on generated archives.
+
+    python3 -m pytest test_zip_reader.py
+
+read_zip_entries must give the same members, in the same order, as
+zipfile.ZipFile(zip_file).infolist(), and refuse the archives zipfile refuses.
+'''
+import zipfile
+
+import pytest
+
+from zip_reader import ZipReaderError, read_zip_entries, read_zip_entry_count, info_entry
+
+# ---------------------------------- Helpers -----------------------------------#
+
+def make_archive(zip_path, names, comment=b"", compression=zipfile.ZIP_DEFLATED):
+    with zipfile.ZipFile(zip_path, 'w', compression=compression) as zip_ref:
+        for name in names:
+            if name.endswith('/'):
+                zip_ref.mkdir(name)
+            else:
+                zip_ref.writestr(name, name.encode('utf-8') * 20)
+        zip_ref.comment = comment
+    return zip_path
+
+def assert_same_entries(zip_path):
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        expected = [info_entry(info) for info in zip_ref.infolist()]
+        names = zip_ref.namelist()
+    entries = read_zip_entries(str(zip_path))
+    assert entries == expected
+    assert [entry[0] for entry in entries] == names
+    assert read_zip_entry_count(str(zip_path)) == len(names)
+    return entries
+
+def assert_both_refuse(zip_path):
+    with pytest.raises(zipfile.BadZipFile):
+        with zipfile.ZipFile(zip_path) as zip_ref:
+            zip_ref.infolist()
+    with pytest.raises(ZipReaderError):
+        read_zip_entries(str(zip_path))
+
+def central_directory_start(zip_path):
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        return zip_ref.start_dir
+
+# ---------------------------------- Tests -----------------------------------#
+
+def test_plain_archive(tmp_path):
+    names = ["a/", "a/one.txt", "a/b/two.txt", "three.txt", "empty/"]
+    make_archive(tmp_path / "plain.zip", names)
+    make_archive(tmp_path / "stored.zip", names, compression=zipfile.ZIP_STORED)
+    assert [entry[0] for entry in assert_same_entries(tmp_path / "plain.zip")] == names
+    assert_same_entries(tmp_path / "stored.zip")
+
+@pytest.mark.parametrize("comment", [b"A comment", b"PK\001\002 in the comment",
+                                     b"x" * (zipfile.ZIP_MAX_COMMENT)])
+def test_archive_with_comment(tmp_path, comment):
+    zip_path = make_archive(tmp_path / "comment.zip", ["a.txt", "b/c.txt"], comment)
+    assert_same_entries(zip_path)
+
+def test_more_than_65535_entries(tmp_path):
+    names = [f"folder{i % 100}/file{i}.txt" for i in range(70000)]
+    zip_path = tmp_path / "many.zip"
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_ref:
+        for name in names:
+            zip_ref.writestr(name, b"")
+    assert len(assert_same_entries(zip_path)) == 70000
+    assert len(read_zip_entries(str(zip_path), 100)) == 100
+
+def test_zip64_sizes_and_offsets(tmp_path, monkeypatch):
+    # A tiny ZIP64 limit gives ZIP64 sizes, offsets and end records without writing 4 GB
+    zip_path = tmp_path / "zip64.zip"
+    monkeypatch.setattr(zipfile, 'ZIP64_LIMIT', 100)
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_STORED) as zip_ref:
+        zip_ref.writestr("small.txt", b"x" * 10)
+        zip_ref.writestr("large.bin", b"y" * 500)
+        with zip_ref.open("forced.bin", 'w', force_zip64=True) as file:
+            file.write(b"z" * 300)
+        zip_ref.writestr("after.txt", b"w" * 50)
+    monkeypatch.undo()
+
+    with open(zip_path, 'rb') as file:
+        assert b"PK\006\006" in file.read()
+    entries = assert_same_entries(zip_path)
+    assert [entry[1] for entry in entries] == [10, 500, 300, 50]
+
+def test_utf8_names(tmp_path):
+    names = ["dossier-été/", "dossier-été/fichier №1.txt", "日本語/名前.txt", "emoji 📦.txt"]
+    zip_path = make_archive(tmp_path / "utf8.zip", names)
+    with zipfile.ZipFile(zip_path) as zip_ref:
+        assert all(info.flag_bits & 0x800 for info in zip_ref.infolist())
+    assert [entry[0] for entry in assert_same_entries(zip_path)] == names
+
+def test_cp437_names(tmp_path):
+    # zipfile writes non-ASCII names in UTF-8: the cp437 bytes are patched in afterwards,
+    # in the local and central headers alike
+    zip_path = make_archive(tmp_path / "cp437.zip", ["caf_/", "caf_/men_.txt"])
+    data = zip_path.read_bytes().replace(b"caf_", b"caf\x82").replace(b"men_", b"men\x81")
+    zip_path.write_bytes(data)
+    names = [entry[0] for entry in assert_same_entries(zip_path)]
+    assert names == ["café/", "café/menü.txt"]
+
+def test_prepended_data(tmp_path):
+    zip_path = make_archive(tmp_path / "archive.zip", ["a.txt", "b/c.txt"])
+    prepended = tmp_path / "prepended.zip"
+    prepended.write_bytes(b"#!/bin/sh\nexit 0\n" * 1000 + zip_path.read_bytes())
+    assert assert_same_entries(prepended) == assert_same_entries(zip_path)
+
+def test_empty_archive(tmp_path):
+    zip_path = make_archive(tmp_path / "empty.zip", [])
+    assert assert_same_entries(zip_path) == []
+    empty_file = tmp_path / "empty_file.zip"
+    empty_file.write_bytes(b"")
+    assert_both_refuse(empty_file)
+
+def test_truncated_archive(tmp_path):
+    zip_path = make_archive(tmp_path / "archive.zip", [f"file{i}.txt" for i in range(100)])
+    data = zip_path.read_bytes()
+    start = central_directory_start(zip_path)
+    truncated = tmp_path / "truncated.zip"
+    truncated.write_bytes(data[:start + (len(data) - start) // 2])
+    assert_both_refuse(truncated)
+
+def test_corrupt_central_directory(tmp_path):
+    zip_path = make_archive(tmp_path / "archive.zip", [f"file{i}.txt" for i in range(100)])
+    data = bytearray(zip_path.read_bytes())
+    # The signature of the 51st central directory header
+    position = central_directory_start(zip_path) - 1
+    for _ in range(51):
+        position = data.index(b"PK\001\002", position + 1)
+    data[position:position + 4] = b"XXXX"
+    corrupt = tmp_path / "corrupt.zip"
+    corrupt.write_bytes(bytes(data))
+    assert_both_refuse(corrupt)
+    # The first members remain readable up to the corrupt one
+    assert [entry[0] for entry in read_zip_entries(str(corrupt), 50)] == \
+        [f"file{i}.txt" for i in range(50)]
+
+def test_corrupt_central_directory_size(tmp_path):
+    zip_path = make_archive(tmp_path / "archive.zip", ["a.txt", "b.txt"])
+    data = bytearray(zip_path.read_bytes())
+    # Points the end record at a central directory larger than the file
+    eocd = data.rindex(b"PK\005\006")
+    data[eocd + 12:eocd + 16] = (len(data) * 2).to_bytes(4, 'little')
+    corrupt = tmp_path / "corrupt.zip"
+    corrupt.write_bytes(bytes(data))
+    assert_both_refuse(corrupt)
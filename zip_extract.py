@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+import zlib
+import heapq
+import bisect
+import struct
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Below this amount of compressed data, starting threads costs more than it saves
+PARALLEL_MIN_BYTES = 8 * 1024 * 1024
+
+LOCAL_HEADER_SIGNATURE = b"PK\003\004"
+LOCAL_HEADER_STRUCT = struct.Struct("<4s22xHH")
+COPY_CHUNK_SIZE = 1024 * 1024
+
+# ---------------------------------- Metadata sidecars -----------------------------------#
+
+def macosx_sidecar(member):
+    # The AppleDouble file in which macOS stores the metadata (tags, etc.) of a member
+    my_dir, name = os.path.split(member.rstrip('/'))
+    if my_dir == "":
+        return '__MACOSX/._' + name
+    return '__MACOSX/' + my_dir + '/._' + name
+
+# ---------------------------------- Member names -----------------------------------#
+
+def member_names(sorted_names, member):
+    # The names of the archive designated by member: itself for a file, all the names
+    # beginning with it for a folder. sorted_names = the sorted names of the archive
+    start = bisect.bisect_left(sorted_names, member)
+    if not member.endswith('/'):
+        return sorted_names[start:start + 1] if sorted_names[start:start + 1] == [member] else []
+    end = bisect.bisect_left(sorted_names, member + '\U0010ffff', start)
+    return sorted_names[start:end]
+
+# ---------------------------------- Single member extraction -----------------------------------#
+
+def member_target_path(member, folder):
+    # Where zipfile extracts a member: no absolute paths, no '.' or '..' components
+    parts = [p for p in member.split('/') if p not in ('', '.', '..')]
+    return os.path.join(folder, *parts)
+
+def member_data_offset(file, info):
+    # The compressed data of a member follows its local header, whose name and extra
+    # field lengths may differ from those of the central directory
+    file.seek(info.header_offset)
+    header = file.read(LOCAL_HEADER_STRUCT.size)
+    if len(header) != LOCAL_HEADER_STRUCT.size:
+        raise zipfile.BadZipFile("Truncated file header")
+    signature, name_len, extra_len = LOCAL_HEADER_STRUCT.unpack(header)
+    if signature != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile("Bad magic number for file header")
+    return info.header_offset + LOCAL_HEADER_STRUCT.size + name_len + extra_len
+
+def copy_file_range_to(src_fd, dst_fd, offset, count):
+    # Copies count bytes at offset of src_fd to dst_fd, within the kernel when possible.
+    # Returns the CRC-32 of the data if it went through Python, None otherwise
+    copied = 0
+    for kernel_copy in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if kernel_copy is None:
+            continue
+        try:
+            while copied < count:
+                if kernel_copy is os.sendfile:
+                    sent = os.sendfile(dst_fd, src_fd, offset + copied, count - copied)
+                else:
+                    sent = os.copy_file_range(src_fd, dst_fd, count - copied, offset + copied)
+                if sent == 0:
+                    break
+                copied += sent
+            if copied == count:
+                return None
+        except OSError:
+            # Not supported between these files (e.g. sendfile to a file on macOS)
+            pass
+
+    # Buffered copy of what remains
+    crc = None
+    if copied == 0:
+        crc = 0
+    while copied < count:
+        chunk = os.pread(src_fd, min(COPY_CHUNK_SIZE, count - copied), offset + copied)
+        if not chunk:
+            raise zipfile.BadZipFile("Truncated file data")
+        os.write(dst_fd, chunk)
+        if crc is not None:
+            crc = zlib.crc32(chunk, crc)
+        copied += len(chunk)
+    return crc
+
+def file_crc(path):
+    crc = 0
+    with open(path, 'rb') as file:
+        while chunk := file.read(COPY_CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+def extract_stored_member(zip_file, info, target_path):
+    # Copies the bytes of a STORED member straight from the archive, then checks its CRC.
+    # A partial or corrupt target is removed
+    with open(zip_file, 'rb') as src:
+        offset = member_data_offset(src, info)
+        if offset + info.file_size > os.fstat(src.fileno()).st_size:
+            raise zipfile.BadZipFile("Truncated file data")
+        dst = open(target_path, 'wb')
+        try:
+            with dst:
+                crc = copy_file_range_to(src.fileno(), dst.fileno(), offset, info.file_size)
+            if crc is None:
+                crc = file_crc(target_path)
+            if crc != info.CRC:
+                raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+        except BaseException:
+            try:
+                os.remove(target_path)
+            except OSError:
+                pass
+            raise
+    return target_path
+
+def extract_member(zip_ref, member, folder):
+    # Same as zip_ref.extract(member, folder), with a zero-copy path for STORED members
+    if not isinstance(zip_ref, zipfile.ZipFile):
+        return zip_ref.extract(member, folder)
+    info = zip_ref.getinfo(member)
+    if (info.compress_type != zipfile.ZIP_STORED or info.is_dir()
+            or info.flag_bits & 0x1 or not isinstance(zip_ref.filename, str)):
+        return zip_ref.extract(member, folder)
+    target_path = member_target_path(member, folder)
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    return extract_stored_member(zip_ref.filename, info, target_path)
+
+# ---------------------------------- Parallel extraction -----------------------------------#
+'''
+A job is a pair (member name, folder to extract it into). Jobs are split between the
+workers by compressed size (largest first, each to the least loaded worker), and every
+worker opens its own handle on the archive, so that decompression (which releases the
+GIL) and writing run on several cores.
+'''
+
+def extraction_size(zip_ref, jobs):
+    # Space taken by the extracted members
+    return sum(zip_ref.getinfo(member).file_size for member, _ in jobs)
+
+def extraction_workers():
+    # Number of parallel workers, set by 'alzibro_extract_workers' (all cores by default)
+    try:
+        workers = int(os.getenv('alzibro_extract_workers') or 0)
+    except ValueError:
+        workers = 0
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return workers
+
+def balance_jobs(jobs, sizes, workers):
+    buckets = [[] for _ in range(workers)]
+    loads = [(0, i) for i in range(workers)]
+    for job, size in sorted(zip(jobs, sizes), key=lambda x: x[1], reverse=True):
+        load, i = heapq.heappop(loads)
+        buckets[i].append(job)
+        heapq.heappush(loads, (load + size, i))
+    return [bucket for bucket in buckets if bucket]
+
+def extract_jobs(zip_file, jobs):
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        for member, folder in jobs:
+            extract_member(zip_ref, member, folder)
+
+def prepare_folders(jobs):
+    # Creates every needed folder beforehand, so that the workers never race to create them
+    for member, folder in jobs:
+        target_path = member_target_path(member, folder)
+        if member.endswith('/'):
+            os.makedirs(target_path, exist_ok=True)
+        else:
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+def extract_members(zip_ref, jobs, workers=None):
+    # zip_ref is an open ZipFile of the archive, used to plan the extraction
+    if workers is None:
+        workers = extraction_workers()
+    sizes = [zip_ref.getinfo(member).compress_size for member, _ in jobs]
+    # Archives nested in another one have no path for the workers to open, and a tar
+    # archive is best read in a single pass
+    if (workers <= 1 or len(jobs) <= 1 or sum(sizes) < PARALLEL_MIN_BYTES
+            or not isinstance(zip_ref, zipfile.ZipFile) or not isinstance(zip_ref.filename, str)):
+        if not isinstance(zip_ref, zipfile.ZipFile):
+            # In the order of the data (e.g. of a compressed tar archive)
+            jobs = sorted(jobs, key=lambda job: zip_ref.getinfo(job[0]).header_offset)
+        for member, folder in jobs:
+            extract_member(zip_ref, member, folder)
+        return
+
+    prepare_folders(jobs)
+    buckets = balance_jobs(jobs, sizes, workers)
+    with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+        futures = [executor.submit(extract_jobs, zip_ref.filename, bucket) for bucket in buckets]
+        for future in futures:
+            # Raises the first error met by a worker
+            future.result()
+
+# ---------------------------------- Integrity verification -----------------------------------#
+'''
+Verifying a member decompresses it and checks its CRC-32 without writing anything. Like
+extractions, verifications are split between workers with their own handles on the archive.
+'''
+
+def verify_member(zip_ref, member):
+    # Returns the error met when reading the member, or "" if it is intact
+    try:
+        with zip_ref.open(member) as source:
+            # zipfile checks the CRC-32 once the end of the member is read
+            while source.read(COPY_CHUNK_SIZE):
+                pass
+    except Exception as e:
+        return str(e) or type(e).__name__
+    return ""
+
+def verify_jobs(zip_file, members):
+    with zipfile.ZipFile(zip_file, 'r') as zip_ref:
+        return {member: verify_member(zip_ref, member) for member in members}
+
+def verify_members(zip_ref, members, workers=None):
+    # Returns {member: error, or "" if it is intact} for the given file members of zip_ref
+    if workers is None:
+        workers = extraction_workers()
+    sizes = [zip_ref.getinfo(member).compress_size for member in members]
+    if (workers <= 1 or len(members) <= 1 or sum(sizes) < PARALLEL_MIN_BYTES
+            or not isinstance(zip_ref.filename, str)):
+        return {member: verify_member(zip_ref, member) for member in members}
+
+    results = {}
+    buckets = balance_jobs(members, sizes, workers)
+    with ThreadPoolExecutor(max_workers=len(buckets)) as executor:
+        futures = [executor.submit(verify_jobs, zip_ref.filename, bucket) for bucket in buckets]
+        for future in futures:
+            results.update(future.result())
+    return results
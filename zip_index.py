@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+import os
+import heapq
+import pickle
+import itertools
+from array import array
+
+INDEX_VERSION = 3
+
+# ---------------------------------- Path functions -----------------------------------#
+
+def parent_path(my_path):
+    # gives the parent path to go to after ⇧↩ — with a particular form for short paths
+    my_path = my_path.rstrip('/')
+    parts = my_path.split('/')
+    if len(parts)<=1:
+        return ""
+    else:
+        return '/'.join(parts[:-1]) +'/'
+
+def is_hidden_entry(my_path):
+    # macOS metadata that is never shown while browsing
+    return my_path.startswith('__MACOSX') or '.DS_Store' in my_path
+
+# ---------------------------------- Entry table -----------------------------------#
+'''
+The entry table holds every indexed path of the archive in columns: the UTF-8 encoded
+names one after the other in a single bytes object, delimited by "offsets", and arrays
+of sizes, compressed sizes, DOS dates and times (as stored in the archive) and CRCs.
+A row is the position of a path in the sorted list of paths, so that a path is found by
+bisection. "sort_keys" packs the usual order of the browser in one integer per row:
+depth first, then folders before files, then names not beginning with '.' first, and
+finally the name. Folders that only appear implicitly have a date and CRC of 0.
+The sizes of a folder are those of all the files it contains, at any depth, and
+"file_counts" gives the number of these files (1 for a file).
+'''
+
+DEPTH_SHIFT = 34
+FILE_BIT = 1 << 33
+DOT_BIT = 1 << 32
+ROW_MASK = DOT_BIT - 1
+
+def entry_sort_key(my_path, row):
+    is_folder = my_path.endswith('/')
+    name = my_path[:-1] if is_folder else my_path
+    key = name.count('/') << DEPTH_SHIFT | row
+    if not is_folder:
+        key |= FILE_BIT
+    if name.startswith('.', name.rfind('/') + 1):
+        key |= DOT_BIT
+    return key
+
+def build_entry_table(paths, entries):
+    # paths = the sorted paths, entries = the tuples of zip_reader for some of them
+    encoded = [my_path.encode('utf-8') for my_path in paths]
+    offsets = array('Q', [0])
+    offsets.extend(itertools.accumulate(map(len, encoded)))
+    no_entry = (None, 0, 0, 0, 0)
+    details = [entries.get(my_path, no_entry) for my_path in paths]
+    return {
+        "names": b''.join(encoded),
+        "offsets": offsets,
+        "sizes": array('Q', [entry[1] for entry in details]),
+        "compressed_sizes": array('Q', [entry[2] for entry in details]),
+        "dos_times": array('I', [entry[3] for entry in details]),
+        "crcs": array('I', [entry[4] for entry in details]),
+        "file_counts": array('I', [not my_path.endswith('/') for my_path in paths]),
+        "sort_keys": array('Q', [entry_sort_key(p, row) for row, p in enumerate(paths)]),
+    }
+
+def entry_count(table):
+    return len(table["sort_keys"])
+
+def entry_path(table, row):
+    offsets = table["offsets"]
+    return table["names"][offsets[row]:offsets[row + 1]].decode('utf-8')
+
+def is_file_entry(table, row):
+    return bool(table["sort_keys"][row] & FILE_BIT)
+
+def bisect_names(table, target):
+    # Returns the first row whose encoded name is not below target. UTF-8 preserves
+    # the order of code points, so the encoded names are in the same order as the paths
+    names, offsets = table["names"], table["offsets"]
+    low, high = 0, entry_count(table)
+    while low < high:
+        middle = (low + high) // 2
+        if names[offsets[middle]:offsets[middle + 1]] < target:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+def find_entry(table, my_path):
+    # Returns the row of my_path, or None
+    target = my_path.encode('utf-8')
+    row = bisect_names(table, target)
+    offsets = table["offsets"]
+    if row < entry_count(table) and table["names"][offsets[row]:offsets[row + 1]] == target:
+        return row
+    return None
+
+def subtree_rows(table, directory):
+    # The paths beginning with directory are contiguous rows: returns their range,
+    # without the directory itself. 0xFF never appears in UTF-8, hence the upper bound
+    prefix = directory.encode('utf-8')
+    low = bisect_names(table, prefix)
+    if directory and low < entry_count(table) and entry_path(table, low) == directory:
+        low += 1
+    return range(low, bisect_names(table, prefix + b'\xff'))
+
+def entry_order_key(table, sort_by):
+    # Key function ordering rows by name (see above), or folders first and then by
+    # decreasing size or date
+    sort_keys = table["sort_keys"]
+    if sort_by == "size":
+        values = table["sizes"]
+    elif sort_by == "date":
+        values = table["dos_times"]
+    else:
+        return sort_keys.__getitem__
+    return lambda row: (sort_keys[row] & FILE_BIT, -values[row], sort_keys[row])
+
+# ---------------------------------- Tree index -----------------------------------#
+'''
+The index holds the entry table of the archive, and maps every directory ("" being the
+root) to the array of the rows of its direct children, already in the default order.
+Directories that only appear implicitly (as the prefix of some member) are added,
+so that any folder can be listed without scanning the whole archive.
+'''
+
+def build_tree_index(entries):
+    # entries = the (path, size, compressed size, DOS time, CRC) tuples of the members
+    children = {"": set()}
+    details = {}
+    for entry in entries:
+        my_path = entry[0]
+        if is_hidden_entry(my_path):
+            continue
+        details[my_path] = entry
+        if my_path.endswith('/'):
+            children.setdefault(my_path, set())
+        # Register the path and its missing ancestors, stopping at the first known one
+        while my_path:
+            parent = parent_path(my_path)
+            siblings = children.setdefault(parent, set())
+            if my_path in siblings:
+                break
+            siblings.add(my_path)
+            my_path = parent
+
+    paths = sorted(p for siblings in children.values() for p in siblings)
+    table = build_entry_table(paths, details)
+    rows = {my_path: row for row, my_path in enumerate(paths)}
+    sort_keys = table["sort_keys"]
+    tree = {}
+    for directory, siblings in children.items():
+        keys = sorted([sort_keys[rows[p]] for p in siblings])
+        tree[directory] = array('I', [key & ROW_MASK for key in keys])
+    add_folder_totals(table, tree, rows)
+    return {"version": INDEX_VERSION, "table": table, "children": tree}
+
+def add_folder_totals(table, tree, rows):
+    # Bottom-up: each folder adds up its children once the deeper folders are done
+    sizes, compressed_sizes = table["sizes"], table["compressed_sizes"]
+    file_counts = table["file_counts"]
+    for directory in sorted(tree, key=lambda d: d.count('/'), reverse=True):
+        if not directory:
+            continue
+        row = rows[directory]
+        for child in tree[directory]:
+            sizes[row] += sizes[child]
+            compressed_sizes[row] += compressed_sizes[child]
+            file_counts[row] += file_counts[child]
+
+def list_directory(index, directory, show_subfolder_contents, offset=0, limit=None,
+                   sort_by="name"):
+    # Returns the rows [offset:offset+limit] of the sorted listing of a folder, and the
+    # total number of entries, in time proportional to the folder's (or its subtree's) size
+    table = index["table"]
+    if show_subfolder_contents == "1":
+        entries = subtree_rows(table, directory)
+        if sort_by not in ("size", "date"):
+            # The sort keys end with the row: sorting them directly is much faster
+            keys = table["sort_keys"][entries.start:entries.stop]
+            if limit is not None and offset + limit < len(keys):
+                keys = heapq.nsmallest(offset + limit, keys)
+            else:
+                keys = sorted(keys)
+            end = None if limit is None else offset + limit
+            return [key & ROW_MASK for key in keys[offset:end]], len(entries)
+    else:
+        entries = index["children"].get(directory, ())
+        if sort_by not in ("size", "date"):
+            # Already in order
+            end = None if limit is None else offset + limit
+            return list(entries[offset:end]), len(entries)
+
+    # Only the entries up to the end of the requested page need to be ordered
+    total = len(entries)
+    key = entry_order_key(table, sort_by)
+    if limit is not None and offset + limit < total:
+        entries = heapq.nsmallest(offset + limit, entries, key=key)
+    else:
+        entries = sorted(entries, key=key)
+    end = None if limit is None else offset + limit
+    return entries[offset:end], total
+
+def is_file_in_index(index, my_path):
+    return not my_path.endswith('/') and find_entry(index["table"], my_path) is not None
+
+#--------------------
+
+def save_index(index, index_file):
+    # Written to a temporary name first so that a concurrent reader never sees a partial file
+    temp_file = index_file + '.tmp'
+    with open(temp_file, 'wb') as file:
+        pickle.dump(index, file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_file, index_file)
+
+def load_index(index_file):
+    with open(index_file, 'rb') as file:
+        index = pickle.load(file)
+    if not isinstance(index, dict) or index.get("version") != INDEX_VERSION:
+        raise ValueError("Outdated index")
+    return index
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+'''
+A minimal reader of the ZIP central directory.
+
+zipfile.ZipFile builds a full ZipInfo object (extra fields, dates, ...) for every member
+when opening an archive. When only the names, sizes, dates and CRCs are needed, it is
+much faster to walk the central directory straight from a memory map of the file.
+Whenever something unusual is met (multi-disk archives, unknown layout, undecodable
+names...) ZipReaderError is raised, and the caller is expected to fall back to zipfile.
+'''
+import os
+import mmap
+import struct
+import contextlib
+
+from remote_zip import is_remote_url, open_archive_file
+
+EOCD_SIGNATURE = b"PK\005\006"
+EOCD_STRUCT = struct.Struct("<4s4H2LH")
+ZIP64_LOCATOR_SIGNATURE = b"PK\006\007"
+ZIP64_LOCATOR_STRUCT = struct.Struct("<4sLQL")
+ZIP64_EOCD_SIGNATURE = b"PK\006\006"
+ZIP64_EOCD_STRUCT = struct.Struct("<4sQ2H2L4Q")
+CENTRAL_DIR_SIGNATURE = b"PK\001\002"
+CENTRAL_DIR_SIZE = 46
+MAX_COMMENT_SIZE = 1 << 16
+# The end of an archive that holds all its end of central directory records
+TAIL_SIZE = MAX_COMMENT_SIZE + 128
+
+UTF8_FLAG = 0x800
+UNICODE_PATH_EXTRA = b"up"  # 0x7075 'Info-ZIP Unicode Path' extra field tag
+ZIP64_EXTRA = 0x0001
+EXTRA_HEADER_STRUCT = struct.Struct("<2H")
+MAX_UINT32 = 0xFFFFFFFF
+
+class ZipReaderError(Exception):
+    pass
+
+# ------------------------------ End of central directory -------------------------------#
+
+def find_central_directory(buf, base=0):
+    # Returns (start, size, number of entries) of the central directory, following
+    # zipfile's conventions (including ZIP64 records and data prepended to the archive).
+    # buf = the bytes of the archive from offset base (at least its last TAIL_SIZE bytes)
+    file_size = base + len(buf)
+    search_start = max(len(buf) - MAX_COMMENT_SIZE - EOCD_STRUCT.size, 0)
+    eocd = buf.rfind(EOCD_SIGNATURE, search_start)
+    if eocd < 0 or eocd + EOCD_STRUCT.size > len(buf):
+        raise ZipReaderError("End of central directory not found")
+    (_, disk, disk_start, _, entry_count, size_cd, offset_cd, _) = EOCD_STRUCT.unpack_from(buf, eocd)
+    records_start = base + eocd
+
+    locator = eocd - ZIP64_LOCATOR_STRUCT.size
+    if locator >= 0 and buf[locator:locator + 4] == ZIP64_LOCATOR_SIGNATURE:
+        _, disk, _, disks = ZIP64_LOCATOR_STRUCT.unpack_from(buf, locator)
+        if disks > 1:
+            raise ZipReaderError("Multi-disk archive")
+        record = locator - ZIP64_EOCD_STRUCT.size
+        if record >= 0 and buf[record:record + 4] == ZIP64_EOCD_SIGNATURE:
+            (_, _, _, _, disk, disk_start, _, entry_count, size_cd, offset_cd) = \
+                ZIP64_EOCD_STRUCT.unpack_from(buf, record)
+            records_start = base + record
+
+    if disk != 0 or disk_start != 0:
+        raise ZipReaderError("Multi-disk archive")
+
+    # "concat" is zero, unless the zip was concatenated to another file
+    concat = records_start - size_cd - offset_cd
+    start = offset_cd + concat
+    if start < 0 or start + size_cd > file_size:
+        raise ZipReaderError("Bad offset for central directory")
+    return start, size_cd, entry_count
+
+# ------------------------------ Central directory -------------------------------#
+
+def decode_name(raw_name, flags):
+    if flags & UTF8_FLAG:
+        name = raw_name.decode('utf-8')
+    else:
+        name = raw_name.decode('cp437')
+    # Like zipfile, terminate the name at the first null byte
+    null_byte = name.find('\0')
+    if null_byte >= 0:
+        name = name[:null_byte]
+    return name
+
+def zip64_sizes(buf, extra_start, extra_len, file_size, compress_size):
+    # Sizes too large for the central directory header are stored in the ZIP64 extra field,
+    # in this order and only if the header holds 0xFFFFFFFF
+    pos = extra_start
+    extra_end = extra_start + extra_len
+    while pos + EXTRA_HEADER_STRUCT.size <= extra_end:
+        tag, size = EXTRA_HEADER_STRUCT.unpack_from(buf, pos)
+        pos += EXTRA_HEADER_STRUCT.size
+        if tag == ZIP64_EXTRA:
+            values = iter(struct.unpack_from(f"<{size // 8}Q", buf, pos))
+            if file_size == MAX_UINT32:
+                file_size = next(values)
+            if compress_size == MAX_UINT32:
+                compress_size = next(values)
+            return file_size, compress_size
+        pos += size
+    raise ZipReaderError("Missing ZIP64 extra field")
+
+def walk_entries(buf, start, size, limit=None):
+    # Returns a (name, size, compressed size, DOS date and time, CRC-32) tuple per member,
+    # or for the first limit members only
+    entries = []
+    append = entries.append
+    # signature, flags, time, date, CRC, sizes and the name/extra/comment lengths
+    # of a central directory header
+    unpack_header = struct.Struct("<4s4xH2x2H3L3H").unpack_from
+    pos = start
+    end = start + size
+    while pos < end:
+        if len(entries) == limit:
+            return entries
+        if pos + CENTRAL_DIR_SIZE > end:
+            raise ZipReaderError("Truncated central directory")
+        (signature, flags, dos_time, dos_date, crc, compress_size, file_size,
+         name_len, extra_len, comment_len) = unpack_header(buf, pos)
+        if signature != CENTRAL_DIR_SIGNATURE:
+            raise ZipReaderError("Bad magic number for central directory")
+        name_start = pos + CENTRAL_DIR_SIZE
+        extra_start = name_start + name_len
+        if extra_len and buf.find(UNICODE_PATH_EXTRA, extra_start, extra_start + extra_len) >= 0:
+            raise ZipReaderError("Unicode path extra field")
+        raw_name = buf[name_start:extra_start]
+        if flags & UTF8_FLAG or raw_name.isascii():
+            # Names are mostly ASCII, for which both encodings agree
+            name = raw_name.decode('utf-8')
+            if '\0' in name:
+                name = decode_name(raw_name, flags)
+        else:
+            name = decode_name(raw_name, flags)
+        if file_size == MAX_UINT32 or compress_size == MAX_UINT32:
+            file_size, compress_size = zip64_sizes(buf, extra_start, extra_len,
+                                                   file_size, compress_size)
+        append((name, file_size, compress_size, dos_date << 16 | dos_time, crc))
+        pos = extra_start + extra_len + comment_len
+    if pos != end:
+        raise ZipReaderError("Truncated central directory")
+    return entries
+
+@contextlib.contextmanager
+def archive_buffer(zip_file):
+    # Yields (file, buf, base): buf holds the bytes of the archive from offset base to its
+    # end. A local archive is memory mapped whole, only the end of a remote one is fetched
+    with open_archive_file(zip_file) as file:
+        if is_remote_url(zip_file):
+            base = max(file.seek(0, os.SEEK_END) - TAIL_SIZE, 0)
+            file.seek(base)
+            yield file, file.read(), base
+            return
+        if os.fstat(file.fileno()).st_size == 0:
+            raise ZipReaderError("Empty file")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            yield file, buf, 0
+
+def read_zip_entries(zip_file, limit=None):
+    # Same members, in the same order, as zipfile.ZipFile(zip_file).infolist()
+    # (only the first limit ones if given: the rest of the file is then never read)
+    try:
+        with archive_buffer(zip_file) as (file, buf, base):
+            start, size, _ = find_central_directory(buf, base)
+            if start < base:
+                # The central directory of a remote archive, fetched at once
+                file.seek(start)
+                buf, base = file.read(size), start
+            return walk_entries(buf, start - base, size, limit)
+    except (ValueError, struct.error, OSError) as e:
+        # UnicodeDecodeError is a ValueError
+        raise ZipReaderError(str(e))
+
+def read_zip_entry_count(zip_file):
+    # Number of members, from the end of the central directory only
+    try:
+        with archive_buffer(zip_file) as (_, buf, base):
+            return find_central_directory(buf, base)[2]
+    except (ValueError, struct.error, OSError) as e:
+        raise ZipReaderError(str(e))
+
+#--------------------
+
+def info_entry(info):
+    # The same tuple as walk_entries, from a zipfile.ZipInfo
+    year, month, day, hour, minute, second = info.date_time
+    dos_date = (year - 1980) << 9 | month << 5 | day
+    dos_time = hour << 11 | minute << 5 | second // 2
+    return (info.filename, info.file_size, info.compress_size, dos_date << 16 | dos_time,
+            info.CRC)